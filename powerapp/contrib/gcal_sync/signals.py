@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 from logging import getLogger
 from django.dispatch.dispatcher import receiver
 from .apps import AppConfig
@@ -33,10 +34,16 @@ def on_task_deleted(sender, integration=None, obj=None, **kwargs):
     bridge.delete_task(td, obj['id'])
 
 
-@receiver(utils.gcal_event_changed)
-def on_gcal_event_changed(sender, integration=None, event=None, **kwargs):
-    bridge = sync_adapter.get_bridge_by_event_id(integration, event['id'])
-    bridge.push_task(bridge.right, event['id'], event)
+@receiver(utils.gcal_events_changed)
+def on_gcal_events_changed(sender, integration=None, events=None, **kwargs):
+    # events of the page can belong to different projects, and therefore
+    # to different bridges
+    bridges = OrderedDict()
+    for event in events:
+        bridge = sync_adapter.get_bridge_by_event_id(integration, event['id'])
+        bridges.setdefault(bridge.name, (bridge, []))[1].append((event['id'], event))
+    for bridge, bridge_events in bridges.values():
+        bridge.push_tasks(bridge.right, bridge_events)
 
 
 @receiver(utils.gcal_event_deleted)
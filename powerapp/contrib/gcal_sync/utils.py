@@ -21,7 +21,7 @@ CALENDAR_SUMMARY = 'Todoist Playground' if settings.DEBUG else 'Todoist'
 WEBHOOK_HMAC_SALT = 'gcal-webhooks'
 
 
-gcal_event_changed = Signal(providing_args=['integration', 'event'])
+gcal_events_changed = Signal(providing_args=['integration', 'events'])
 gcal_event_deleted = Signal(providing_args=['integration', 'event_id'])
 
 
@@ -139,13 +139,17 @@ def sync_gcal(integration):
         page_token = json_resp.get('nextPageToken')
         sync_token = json_resp.get('nextSyncToken')
 
+        changed_events = []
         for gcal_event in json_resp['items']:
             if gcal_event['status'] == 'cancelled':
                 gcal_event_deleted.send(None, integration=integration,
                                         event_id=gcal_event['id'])
             else:
-                gcal_event_changed.send(None, integration=integration,
-                                        event=gcal_event)
+                changed_events.append(gcal_event)
+
+        if changed_events:
+            gcal_events_changed.send(None, integration=integration,
+                                     events=changed_events)
 
         if not page_token:
             integration.update_settings(sync_token=sync_token)
@@ -11,10 +11,18 @@ class TodoistSyncSignal(Signal):
 
     SYNC_SIGNAL_ARGS = ['integration', 'obj']
 
+    # sync resource types providing objects for signals
+    RESOURCE_TYPES = {
+        models.Project: 'projects',
+        models.Item: 'items',
+        models.Note: 'notes',
+    }
+
     def __init__(self, name, model):
         super(TodoistSyncSignal, self).__init__(providing_args=self.SYNC_SIGNAL_ARGS)
         self.name = name
         self.model = model
+        self.resource_type = self.RESOURCE_TYPES[model]
 
     def fire(self, integration, obj):
         """
@@ -59,6 +67,17 @@ class ServiceAppSignals(object):
         self.todoist_note_updated = TodoistSyncSignal('todoist_note_updated', models.Note)
         self.todoist_note_deleted = TodoistSyncSignal('todoist_note_deleted', models.Note)
 
+    def get_resource_types(self):
+        """
+        Return the sorted list of sync resource types we need to request to
+        fire signals which have listeners. The empty list means that nobody
+        listens to the signals, and the sync is pointless.
+        """
+        return sorted({signal_obj.resource_type
+                       for signal_obj in self.__dict__.values()
+                       if isinstance(signal_obj, TodoistSyncSignal)
+                       and signal_obj.has_listeners()})
+
     def __getitem__(self, item):
         """
         :rtype: Signal
@@ -9,30 +9,189 @@ Basically, we run two types of tasks.
 - If the service defines some cron job (like, polling external service), we
   perform these periodic tasks as well (PeriodicTask instances)
 """
+from collections import defaultdict, OrderedDict
 from logging import getLogger
 from powerapp.celery_local import app
+from powerapp.core import sync_scheduler
 from powerapp.core.models import Integration, PeriodicTask
+from powerapp.core.logging_utils import ctx
+from powerapp.core.models.integration import get_next_sync, get_sync_period
+from powerapp.core.service_collector import get_service_app_configs
+from powerapp.core.sync import sync_integrations
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import Case, When, Value, DateTimeField
 from django.utils.timezone import now
 
 
 logger = getLogger(__name__)
 
 
+# the max number of rows to claim in one transaction
+CLAIM_CHUNK_SIZE = 500
+
+# the default number of ids to send to workers in one message
+DISPATCH_BATCH_SIZE = 50
+
+
 @app.task(ignore_result=True)
-def schedule_sync_tasks():
+def schedule_sync_tasks(batch_size=DISPATCH_BATCH_SIZE):
     """
     A celery beat task which by itself does nothing but schedule a buch of
     sync tasks for execution
 
-    For every integration object we acquire a lock, and pass this lock object
-    to the worker. If lock is unable to acquire then probably another task is
-    performing the sync operation right now. Don't do anything at all.
+    Due integrations are claimed in chunks: rows are locked with
+    "SELECT ... FOR UPDATE SKIP LOCKED", and their next sync is moved forward
+    in one statement per chunk. Rows claimed by another scheduler are skipped,
+    so it's safe to run several schedulers at once.
+
+    Claimed integrations are sent to workers in batches of `batch_size` ids.
+
+    If the Redis scheduler is enabled, the task dispatches due integrations
+    from the Redis schedule instead of scanning the database. The empty
+    schedule is populated from the database first.
+
+    Integrations of services without receivers of sync signals aren't synced
+    at all (see `get_synced_services`).
+    """
+    if sync_scheduler.enabled():
+        if sync_scheduler.next_due() is None:
+            # the schedule is empty: either it's the first run, or Redis
+            # lost its data
+            rebuild_sync_schedule()
+        while dispatch_due_syncs(batch_size):
+            pass
+        return
+
+    while True:
+        integration_ids = claim_due_integrations()
+        dispatch_sync_tasks(integration_ids, batch_size)
+        if len(integration_ids) < CLAIM_CHUNK_SIZE:
+            break
+
+
+def claim_due_integrations(limit=CLAIM_CHUNK_SIZE):
+    """
+    Claim the chunk of stateful integrations which have to be synced, move
+    their next sync forward, and return the list of their ids
+    """
+    service_ids = get_synced_services()
+    if not service_ids:
+        return []
+    sql = (
+        'SELECT id, api_idle_syncs FROM {table} '
+        'WHERE service_enabled = %s AND stateless = %s AND api_next_sync <= %s '
+        'AND service_id IN ({services}) '
+        'ORDER BY api_next_sync LIMIT %s {lock}'
+    ).format(table=connection.ops.quote_name(Integration._meta.db_table),
+             services=', '.join(['%s'] * len(service_ids)),
+             lock=skip_locked_clause())
+    sync_time = now()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [True, False, sync_time] + service_ids + [limit])
+            rows = cursor.fetchall()
+        advance_next_sync(rows, sync_time)
+    return [integration_id for integration_id, _ in rows]
+
+
+def advance_next_sync(rows, sync_time):
+    """
+    Mark integrations as synced at `sync_time`, and move their next sync
+    forward to their personal slots, all in one statement. Accepts the list
+    of (integration_id, api_idle_syncs) tuples.
+
+    Return the list of (integration_id, next_sync) tuples
+    """
+    schedule_items = [(integration_id,
+                       get_next_sync(integration_id, sync_time,
+                                     get_sync_period(idle_syncs)))
+                      for integration_id, idle_syncs in rows]
+    integration_ids = [integration_id for integration_id, _ in schedule_items]
+    if schedule_items:
+        whens = [When(id=integration_id, then=Value(next_sync))
+                 for integration_id, next_sync in schedule_items]
+        Integration.objects.filter(id__in=integration_ids).update(
+            api_last_sync=sync_time,
+            api_next_sync=Case(*whens, output_field=DateTimeField()))
+    return schedule_items
+
+
+def dispatch_sync_tasks(integration_ids, batch_size=DISPATCH_BATCH_SIZE):
+    for batch in split(integration_ids, batch_size):
+        run_sync_tasks.delay(batch)
+
+
+def split(ids, batch_size):
+    """
+    Split the list of ids into batches of batch_size elements
+    """
+    return [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+
+def dispatch_due_syncs(batch_size=DISPATCH_BATCH_SIZE):
+    """
+    Pop due integrations from the Redis schedule, move their next sync
+    forward, and send them to workers.
+
+    Return the number of integrations popped from the schedule
+    """
+    popped_ids = sync_scheduler.pop_due(now())
+    if not popped_ids:
+        return 0
+
+    # integrations could be deleted, disabled or become stateless since they
+    # were scheduled. Drop them from the schedule
+    rows = list(Integration.objects.filter(id__in=popped_ids,
+                                           stateless=False,
+                                           service_enabled=True)
+                .values_list('id', 'api_idle_syncs', 'service_id'))
+    sync_scheduler.schedule(advance_next_sync([row[:2] for row in rows], now()))
+    # integrations of services without receivers stay in the schedule, but
+    # aren't synced
+    service_ids = set(get_synced_services())
+    integration_ids = [integration_id for integration_id, _, service_id in rows
+                       if service_id in service_ids]
+    dispatch_sync_tasks(integration_ids, batch_size)
+    return len(popped_ids)
+
+
+def get_sync_resource_types(service_id):
+    """
+    Return the list of resource types to request for integrations of the
+    service, or the empty list, if they don't need syncs
+    """
+    try:
+        return apps.get_app_config(service_id).signals.get_resource_types()
+    except LookupError:
+        return []
+
+
+def get_synced_services():
+    """
+    Return the list of labels of stateful services which need periodic
+    syncs, i.e. have receivers of sync signals
     """
-    for integration in Integration.objects.filter(stateless=False,
-                                                  api_next_sync__lte=now()):
-        integration.api_last_sync = now()
-        integration.save(update_fields=['api_last_sync'])
-        run_sync_task.delay(integration.id)
+    return sorted(label for label, app_config in get_service_app_configs().items()
+                  if not app_config.stateless
+                  and app_config.signals.get_resource_types())
+
+
+def rebuild_sync_schedule():
+    """
+    Populate the Redis schedule with all enabled stateful integrations from
+    the database
+    """
+    integrations = (Integration.objects.filter(stateless=False,
+                                               service_enabled=True)
+                    .values_list('id', 'api_next_sync'))
+    chunk = []
+    for item in integrations.iterator():
+        chunk.append(item)
+        if len(chunk) >= sync_scheduler.POP_LIMIT:
+            sync_scheduler.schedule(chunk)
+            chunk = []
+    sync_scheduler.schedule(chunk)
 
 
 @app.task(ignore_result=True)
@@ -44,17 +203,135 @@ def run_sync_task(integration_id):
         integration = Integration.objects.get(id=integration_id)
     except Integration.DoesNotExist:
         return
-    integration.api.sync(resource_types=['projects', 'items', 'notes'])
+    resource_types = get_sync_resource_types(integration.service_id)
+    if resource_types:
+        integration.api.sync(resource_types=resource_types)
 
 
 @app.task(ignore_result=True)
-def schedule_cron_tasks():
+def run_sync_tasks(integration_ids):
+    """
+    Perform sync operation for a batch of "stateful integrations". A failure
+    of one integration doesn't affect the rest of the batch.
+
+    Integrations of the same user share Todoist sync requests. Other
+    stateful integrations of these users join the sync if they can (see
+    `sync_integrations`), and their next sync is moved forward, so that we
+    sync every user once per due time.
+
+    Every integration requests only resource types its service has receivers
+    for, and only integrations requesting the same resource types can share
+    a request.
+    """
+    integrations = list(Integration.objects.filter(id__in=integration_ids)
+                        .select_related('user', 'service'))
+    siblings = (Integration.objects
+                .filter(user_id__in={i.user_id for i in integrations},
+                        stateless=False, service_enabled=True)
+                .exclude(id__in=integration_ids)
+                .select_related('user', 'service'))
+
+    groups = OrderedDict()
+    for integration in integrations:
+        resource_types = tuple(get_sync_resource_types(integration.service_id))
+        if resource_types:
+            groups.setdefault(resource_types, ([], []))[0].append(integration)
+    for integration in siblings:
+        resource_types = tuple(get_sync_resource_types(integration.service_id))
+        if resource_types in groups:
+            groups[resource_types][1].append(integration)
+
+    synced_siblings = []
+    for resource_types, (group, group_siblings) in groups.items():
+        synced_siblings += sync_integrations(group, list(resource_types),
+                                             siblings=group_siblings)
+    rows = [(i.id, i.api_idle_syncs) for i in synced_siblings]
+    sync_scheduler.schedule(advance_next_sync(rows, now()))
+
+
+@app.task(ignore_result=True)
+def schedule_cron_tasks(batch_size=DISPATCH_BATCH_SIZE):
     """
     A celery beat task schedules cron tasks for execution
+
+    Due tasks are claimed in chunks the same way as in `schedule_sync_tasks`,
+    so it's safe to run several schedulers at once. Claimed tasks are sent to
+    workers in batches of `batch_size` ids.
+    """
+    while True:
+        claimed_cnt, ptask_ids = claim_due_periodic_tasks()
+        for batch in split(ptask_ids, batch_size):
+            run_cron_tasks.delay(batch)
+        if claimed_cnt < CLAIM_CHUNK_SIZE:
+            break
+
+
+def claim_due_periodic_tasks(limit=CLAIM_CHUNK_SIZE):
+    """
+    Claim the chunk of periodic tasks which have to be run, and move their
+    next run forward. Tasks unknown to their services are deleted.
+
+    Return the number of claimed tasks and the list of ids of tasks to run
     """
-    for ptask in PeriodicTask.objects.filter(next_run__lt=now()):
-        ptask.schedule_forward()
-        run_cron_task.delay(ptask.id)
+    sql = (
+        'SELECT pt.id, pt.name, i.service_id FROM {ptask_table} pt '
+        'INNER JOIN {integration_table} i ON pt.integration_id = i.id '
+        'WHERE pt.next_run < %s ORDER BY pt.next_run LIMIT %s {lock}'
+    ).format(ptask_table=connection.ops.quote_name(PeriodicTask._meta.db_table),
+             integration_table=connection.ops.quote_name(Integration._meta.db_table),
+             lock=skip_locked_clause('pt'))
+    run_time = now()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [run_time, limit])
+            rows = cursor.fetchall()
+
+        # group tasks by their next run
+        next_runs = defaultdict(list)
+        unknown_ids = []
+        for ptask_id, name, service_id in rows:
+            task_fun = get_task_fun(service_id, name)
+            if task_fun:
+                next_runs[run_time + task_fun.delta].append(ptask_id)
+            else:
+                unknown_ids.append(ptask_id)
+
+        if next_runs:
+            whens = [When(id__in=ids, then=Value(next_run))
+                     for next_run, ids in next_runs.items()]
+            ptask_ids = sum(next_runs.values(), [])
+            PeriodicTask.objects.filter(id__in=ptask_ids).update(
+                next_run=Case(*whens, output_field=DateTimeField()))
+        else:
+            ptask_ids = []
+
+        if unknown_ids:
+            PeriodicTask.objects.filter(id__in=unknown_ids).delete()
+
+    return len(rows), ptask_ids
+
+
+def get_task_fun(service_id, name):
+    """
+    Return PeriodicTaskFun object by service label and task name, or None
+    """
+    try:
+        return apps.get_app_config(service_id).periodic_tasks.get(name)
+    except LookupError:
+        return None
+
+
+def skip_locked_clause(of=None):
+    """
+    Return the clause to lock selected rows, skipping rows locked by other
+    transactions. Only PostgreSQL supports it, other databases (like SQLite
+    in dev environment) get the empty string
+    """
+    if connection.vendor != 'postgresql':
+        return ''
+    if of:
+        return 'FOR UPDATE OF %s SKIP LOCKED' % of
+    return 'FOR UPDATE SKIP LOCKED'
 
 
 @app.task(ignore_result=True)
@@ -67,3 +344,19 @@ def run_cron_task(periodic_task_id):
     except PeriodicTask.DoesNotExist:
         return
     task.run()
+
+
+@app.task(ignore_result=True)
+def run_cron_tasks(periodic_task_ids):
+    """
+    Run a batch of periodic cron jobs. A failure of one job doesn't affect
+    the rest of the batch
+    """
+    ptasks = (PeriodicTask.objects.filter(id__in=periodic_task_ids)
+              .select_related('integration__user', 'integration__service'))
+    for ptask in ptasks:
+        try:
+            ptask.run()
+        except Exception:
+            with ctx(user=ptask.integration.user, integration=ptask.integration):
+                logger.exception('Unable to run periodic task %r', ptask.name)
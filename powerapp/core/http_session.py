@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+The process-wide pool of keep-alive HTTP connections for Todoist API clients.
+
+API objects are created per integration and per user, and without the
+shared session every one of them would open its own connections (and pay
+for the TLS handshake). Instead, all clients of the process share one
+`requests.Session` with the bounded connection pool.
+
+Connections must never be shared between processes. Celery prefork and
+uWSGI (unless "lazy-apps" is on) fork workers after the application is
+loaded, and the session could be created by then. That's why we keep the
+pid of the process which created the session, and start a new session in
+the child.
+"""
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django_statsd.clients import statsd
+
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Return the HTTP session of the current process
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session_pid != pid:
+        with _lock:
+            if _session_pid != pid:
+                # don't close the session inherited from the parent: its
+                # sockets are still used by the parent process
+                _session = create_session()
+                _session_pid = pid
+    return _session
+
+
+def create_session():
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=settings.TODOIST_HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def request(method, url, endpoint, **kwargs):
+    """
+    Send the HTTP request with the shared session, and collect metrics of
+    the endpoint (like "sync" or "query")
+    """
+    kwargs.setdefault('timeout', settings.TODOIST_HTTP_TIMEOUT)
+    endpoint = endpoint.replace('/', '_')
+    start_time = time.time()
+    try:
+        return get_session().request(method, url, **kwargs)
+    except requests.RequestException:
+        statsd.incr('core.http.%s.error_cnt' % endpoint)
+        raise
+    finally:
+        ms = int((time.time() - start_time) * 1000)
+        statsd.incr('core.http.%s.cnt' % endpoint)
+        statsd.gauge('core.http.%s.runtime_ms' % endpoint, ms)
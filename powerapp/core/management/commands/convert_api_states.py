@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+A management command to convert API states of users and integrations from
+the legacy pickled format to the compact one. States which aren't converted
+are still readable, and are converted on the next sync anyway.
+"""
+from django.core.management.base import NoArgsCommand
+
+from powerapp.core.models import Integration, User
+from powerapp.core.sync import StatefulTodoistAPI, UserTodoistAPI
+
+CHUNK_SIZE = 100
+
+
+class Command(NoArgsCommand):
+
+    help = 'Convert pickled API states to the compressed format'
+
+    def handle_noargs(self, **options):
+        for model, api_class in [(User, UserTodoistAPI),
+                                 (Integration, StatefulTodoistAPI)]:
+            converted = 0
+            ids = list(model.objects.filter(api_state_pickled__isnull=False)
+                       .values_list('id', flat=True))
+            for i in range(0, len(ids), CHUNK_SIZE):
+                objects = (model.objects.filter(id__in=ids[i:i + CHUNK_SIZE])
+                           .only('id', 'api_state_pickled'))
+                for obj in objects:
+                    if obj.api_state_pickled:
+                        api_state = api_class.deserialize(obj.api_state_pickled).serialize()
+                    else:
+                        # legacy empty states (like '') mean "no state", and
+                        # have to stay empty, so that the API falls back to
+                        # the API token of the user
+                        api_state = None
+                    converted += (model.objects
+                                  .filter(id=obj.id, api_state_pickled__isnull=False)
+                                  .update(api_state=api_state, api_state_pickled=None))
+            self.stdout.write('%d %s states converted' % (converted, model._meta.model_name))
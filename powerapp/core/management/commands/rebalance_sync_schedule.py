@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+A management command to spread next syncs of existing stateful integrations
+evenly across the sync period, so that integrations created or reset
+together don't hit Todoist all at once.
+"""
+import datetime
+from django.core.management.base import NoArgsCommand
+from django.db.models import Case, When, Value, DateTimeField
+from django.utils.timezone import now
+
+from powerapp.core import sync_scheduler
+from powerapp.core.models import Integration
+from powerapp.core.models.integration import get_next_sync, get_sync_period
+
+CHUNK_SIZE = 500
+
+
+class Command(NoArgsCommand):
+
+    help = 'Move next syncs of stateful integrations to their personal slots'
+
+    def handle_noargs(self, **options):
+        rows = list(Integration.objects.filter(stateless=False,
+                                               service_enabled=True)
+                    .values_list('id', 'api_idle_syncs'))
+        threshold = now()
+        for i in range(0, len(rows), CHUNK_SIZE):
+            schedule_items = [(integration_id,
+                               get_next_sync(integration_id, threshold,
+                                             get_sync_period(idle_syncs),
+                                             min_interval=datetime.timedelta(0)))
+                              for integration_id, idle_syncs in rows[i:i + CHUNK_SIZE]]
+            chunk = [integration_id for integration_id, _ in schedule_items]
+            whens = [When(id=integration_id, then=Value(next_sync))
+                     for integration_id, next_sync in schedule_items]
+            Integration.objects.filter(id__in=chunk).update(
+                api_next_sync=Case(*whens, output_field=DateTimeField()))
+            sync_scheduler.schedule(schedule_items)
+        self.stdout.write('%d integrations rebalanced' % len(rows))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+A management command running the dispatcher of the Redis sync scheduler.
+
+The dispatcher pops due integrations from the schedule and sends them to
+Celery workers with the sub-second precision. It's safe to run several
+dispatchers at once.
+"""
+import time
+from django.core.management.base import NoArgsCommand, CommandError
+
+from powerapp.core import cron, sync_scheduler
+
+# never sleep longer than that, as new syncs can be scheduled at any moment
+MAX_DELAY = 0.5
+
+
+class Command(NoArgsCommand):
+
+    help = 'Dispatch syncs of stateful integrations from the Redis schedule'
+
+    def handle_noargs(self, **options):
+        if not sync_scheduler.enabled():
+            raise CommandError('Set SYNC_SCHEDULER=redis to use the Redis scheduler')
+
+        cron.rebuild_sync_schedule()
+        while True:
+            cron.dispatch_due_syncs()
+            next_due = sync_scheduler.next_due()
+            delay = MAX_DELAY if next_due is None else next_due - time.time()
+            time.sleep(min(max(delay, 0), MAX_DELAY))
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_service_enabled_flag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='integration',
+            name='api_idle_syncs',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
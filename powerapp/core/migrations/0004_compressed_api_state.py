@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import picklefield.fields
+import powerapp.core.state_codec
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_integration_api_idle_syncs'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='integration',
+            old_name='api_state',
+            new_name='api_state_pickled',
+        ),
+        migrations.AlterField(
+            model_name='integration',
+            name='api_state_pickled',
+            field=picklefield.fields.PickledObjectField(null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='integration',
+            name='api_state',
+            field=powerapp.core.state_codec.CompressedStateField(null=True),
+        ),
+        migrations.RenameField(
+            model_name='user',
+            old_name='api_state',
+            new_name='api_state_pickled',
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='api_state_pickled',
+            field=picklefield.fields.PickledObjectField(null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='api_state',
+            field=powerapp.core.state_codec.CompressedStateField(null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import powerapp.core.state_codec
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_compressed_api_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateObject',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('resource', models.CharField(max_length=32)),
+                ('object_key', models.CharField(max_length=255)),
+                ('data', powerapp.core.state_codec.CompressedStateField()),
+                ('integration', models.ForeignKey(related_name='state_objects', to='core.Integration')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='stateobject',
+            unique_together=set([('integration', 'resource', 'object_key')]),
+        ),
+    ]
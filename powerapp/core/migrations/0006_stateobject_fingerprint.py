@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_stateobject'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stateobject',
+            name='fingerprint',
+            field=models.CharField(max_length=16, blank=True, default=''),
+        ),
+    ]
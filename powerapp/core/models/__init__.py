@@ -4,3 +4,4 @@ from .service import Service
 from .periodic_task import PeriodicTask
 from .user import User
 from .oauth import OAuthToken
+from .state_object import StateObject
@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
+import math
+import random
 from django.db import models
 from django.utils.timezone import now, make_aware
 from django.conf import settings
 from django.apps import apps
+from django.utils.encoding import force_bytes
 from django.utils.functional import cached_property
 from picklefield import PickledObjectField
+from powerapp.core import sync_scheduler
+from powerapp.core.state_codec import CompressedStateField
 from powerapp.core.sync import TodoistAPI
 
 
 SYNC_PERIOD = datetime.timedelta(minutes=1 if settings.DEBUG else 30)
+SYNC_JITTER = SYNC_PERIOD / 20
+
+# dormant integrations are synced less and less often, but not less often
+# than that
+MAX_SYNC_PERIOD = SYNC_PERIOD * 32
 
 
 class Integration(models.Model):
@@ -24,9 +35,13 @@ class Integration(models.Model):
 
     # API client fields
     stateless = models.BooleanField(default=True)
-    api_state = PickledObjectField()
+    api_state = CompressedStateField(null=True)
+    # the legacy storage of the API state, see the convert_api_states command
+    api_state_pickled = PickledObjectField(null=True)
     api_last_sync = models.DateTimeField(default=MILLENIUM)
     api_next_sync = models.DateTimeField(default=MILLENIUM)
+    # the number of consecutive syncs which didn't bring any changes
+    api_idle_syncs = models.PositiveIntegerField(default=0)
 
     # enabled status (cache value from the "service" field)
     service_enabled = models.BooleanField(default=True, editable=False)
@@ -55,6 +70,8 @@ class Integration(models.Model):
     def reset_api(self):
         if not self.stateless:
             self.api_state = None
+            self.api_state_pickled = None
+            self.state_objects.all().delete()
             self.api_last_sync = self.MILLENIUM
             self.api_next_sync = self.MILLENIUM
             self.api = TodoistAPI.create(self)
@@ -80,5 +97,46 @@ class Integration(models.Model):
         threshold = self.api_last_sync or now()
         if not self.stateless and (not self.api_next_sync
                                    or self.api_next_sync < threshold):
-            self.api_next_sync = threshold + SYNC_PERIOD
+            self.api_next_sync = get_next_sync(self.id, threshold,
+                                               get_sync_period(self.api_idle_syncs))
         super(Integration, self).save(**kwargs)
+        update_fields = kwargs.get('update_fields')
+        if (not self.stateless and self.service_enabled
+                and (update_fields is None or 'api_next_sync' in update_fields)):
+            # never postpone the sync scheduled by the webhook handler
+            sync_scheduler.schedule_earlier([self.id], self.api_next_sync)
+
+
+def get_sync_period(idle_syncs):
+    """
+    Return the sync period of the integration. The period doubles after
+    every sync which didn't bring any changes, up to MAX_SYNC_PERIOD
+    """
+    return min(SYNC_PERIOD * 2 ** min(idle_syncs, 16), MAX_SYNC_PERIOD)
+
+
+def get_next_sync(integration_id, threshold, sync_period=SYNC_PERIOD,
+                  min_interval=None):
+    """
+    Return the time of the next sync of the integration.
+
+    Every integration has its own slot within the sync period, defined by
+    the hash of its id, so that integrations created or synced together
+    don't hit Todoist all at once. We return the first slot which is at
+    least `min_interval` (half of the period by default) after the
+    threshold, with a bit of random jitter.
+    """
+    if min_interval is None:
+        min_interval = sync_period / 2
+    period = sync_period.total_seconds()
+    if integration_id is None:
+        offset = random.uniform(0, period)
+    else:
+        digest = hashlib.md5(force_bytes(integration_id)).hexdigest()
+        offset = int(digest[:8], 16) % period
+
+    timestamp = sync_scheduler.to_timestamp(threshold)
+    earliest = timestamp + min_interval.total_seconds()
+    slot = offset + math.ceil((earliest - offset) / period) * period
+    jitter = random.uniform(0, SYNC_JITTER.total_seconds())
+    return threshold + datetime.timedelta(seconds=slot + jitter - timestamp)
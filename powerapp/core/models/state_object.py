@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+from powerapp.core.state_codec import CompressedStateField
+
+
+class StateObject(models.Model):
+    """
+    An object (task, project, note, etc) of the API state of a stateful
+    integration. See `StatefulTodoistAPI.save_state` for details
+    """
+    integration = models.ForeignKey('Integration', related_name='state_objects')
+    resource = models.CharField(max_length=32)
+    object_key = models.CharField(max_length=255)
+    data = CompressedStateField()
+    # the fingerprint of the object, see `powerapp.core.sync.get_fingerprint`
+    fingerprint = models.CharField(max_length=16, blank=True, default='')
+
+    class Meta:
+        app_label = 'core'
+        unique_together = [('integration', 'resource', 'object_key')]
+
+    def __str__(self):
+        return '%s:%s' % (self.resource, self.object_key)
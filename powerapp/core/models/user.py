@@ -9,10 +9,17 @@ from django.utils.functional import cached_property
 from django.utils.timezone import now, make_aware
 from picklefield.fields import PickledObjectField
 from todoist.api import TodoistAPI
+from powerapp.core.redis_utils import get_redis
+from powerapp.core.state_codec import CompressedStateField
 from powerapp.core.sync import UserTodoistAPI
 
 SYNC_PERIOD = datetime.timedelta(minutes=1 if settings.DEBUG else 30)
 
+# the key is set while the background refresh of the user's API state is
+# scheduled or running
+API_REFRESH_KEY = 'user-api-refresh-%s'
+API_REFRESH_TIMEOUT = 60 * 5
+
 
 class UserManager(models.Manager):
 
@@ -49,7 +56,9 @@ class User(AbstractBaseUser):
     api_token = models.CharField(db_index=True, max_length=255)
 
     # we use these data exclusively to keep track of user personal data
-    api_state = PickledObjectField()
+    api_state = CompressedStateField(null=True)
+    # the legacy storage of the API state, see the convert_api_states command
+    api_state_pickled = PickledObjectField(null=True)
     api_last_sync = models.DateTimeField(default=MILLENIUM, db_index=True)
 
     @cached_property
@@ -61,15 +70,37 @@ class User(AbstractBaseUser):
 
         For tasks and items most likely you should use integration-attached
         API objects
+
+        If `settings.USER_API_STALE_WHILE_REVALIDATE` is on, and the stored
+        state is outdated, we return it anyway, and refresh it in background
         """
         obj = UserTodoistAPI.create(self)
         if self.api_last_sync < now() - SYNC_PERIOD:
-            obj.sync(resource_types=["projects", "labels", "filters"])
-            obj.user.sync()
+            if (settings.USER_API_STALE_WHILE_REVALIDATE
+                    and (self.api_state or self.api_state_pickled)):
+                self.schedule_api_refresh()
+            else:
+                self.refresh_api(obj)
         return obj
 
+    def refresh_api(self, api):
+        api.sync(resource_types=["projects", "labels", "filters"])
+        api.user.sync()
+
+    def schedule_api_refresh(self):
+        """
+        Schedule the background refresh of the API state, unless it's
+        already scheduled or running
+        """
+        # it's inside the function, because the tasks module imports models
+        from powerapp.core.tasks import refresh_user_api
+        if get_redis().set(API_REFRESH_KEY % self.id, 1, nx=True,
+                           ex=API_REFRESH_TIMEOUT):
+            refresh_user_api.delay(self.id)
+
     def reset_api(self):
-        self.api_state = ''
+        self.api_state = None
+        self.api_state_pickled = None
         self.api_last_sync = self.MILLENIUM
         self.save()
 
@@ -5,7 +5,7 @@ from django.dispatch import receiver
 from django_statsd.clients import statsd
 
 from .models import Integration, Service
-from . import periodic_tasks
+from . import periodic_tasks, sync_scheduler, webhook_routes
 
 
 @receiver(post_save, sender=Integration)
@@ -17,7 +17,26 @@ def on_integration_create(sender, instance=None, created=None, **kwargs):
 
 @receiver(post_save, sender=Service)
 def change_enabled_status_on_service_update(sender, instance=None, created=None, **kwargs):
-    Integration.objects.filter(service=instance).update(service_enabled=instance.enabled)
+    integrations = Integration.objects.filter(service=instance)
+    integrations.update(service_enabled=instance.enabled)
+    webhook_routes.invalidate(*set(integrations.values_list('user_id', flat=True)))
+
+    stateful_integrations = integrations.filter(stateless=False)
+    if instance.enabled:
+        sync_scheduler.schedule(stateful_integrations.values_list('id', 'api_next_sync'))
+    else:
+        sync_scheduler.unschedule(list(stateful_integrations.values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Integration)
+@receiver(post_delete, sender=Integration)
+def invalidate_webhook_routes(sender, instance=None, **kwargs):
+    webhook_routes.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=Integration)
+def unschedule_sync(sender, instance=None, **kwargs):
+    sync_scheduler.unschedule([instance.id])
 
 
 @receiver(post_save, sender=Integration)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Redis-backed single-flight calls.
+
+`run(key, func)` calls the function unless another thread or process is
+already calling a function with the same key. In that case we wait for the
+call in flight to finish, and return its result instead of repeating the
+work. The caller in flight holds the lease (the Redis key with the timeout,
+whose value is the unique token of the flight), and hands the result off to
+waiters with another short-living key, bound to the token of the flight.
+
+Only callers which waited for the flight get its result. Calls made after
+the flight is over don't see it, and are made anew.
+
+Results have to be JSON-serializable. If the function raises an exception,
+nothing is handed off, and one of waiters makes the call by itself.
+"""
+import json
+import time
+import uuid
+from django.utils.encoding import force_text
+from django_statsd.clients import statsd
+from powerapp.core.redis_utils import get_redis
+
+
+LEASE_KEY = 'single-flight-lease-%s'
+RESULT_KEY = 'single-flight-result-%s-%s'
+
+# for how long (in seconds) the call can hold the lease, and for how long
+# waiters wait for the result before making the call by themselves
+LEASE_TIMEOUT = 60
+
+# for how long (in seconds) we keep the result for waiters. Waiters poll
+# every POLL_INTERVAL seconds, so it doesn't have to be long
+RESULT_TTL = 5
+
+POLL_INTERVAL = 0.05
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def run(key, func, lease_timeout=LEASE_TIMEOUT, result_ttl=RESULT_TTL):
+    """
+    Call the function, or wait for the call with the same key in flight.
+
+    Return the tuple (shared, result), where `shared` is True if the result
+    was made by another caller.
+    """
+    redis = get_redis()
+    lease_key = LEASE_KEY % key
+    token = uuid.uuid4().hex
+    deadline = time.time() + lease_timeout
+    # the token of the flight we wait for
+    flight = None
+    while True:
+        if flight is not None:
+            raw_result = redis.get(RESULT_KEY % (key, flight))
+            if raw_result is not None:
+                statsd.incr('core.single_flight.shared.cnt')
+                return True, json.loads(force_text(raw_result))
+        if redis.set(lease_key, token, nx=True, ex=lease_timeout):
+            break
+        if time.time() > deadline:
+            # the caller in flight is stuck, don't wait for it anymore
+            break
+        current_flight = redis.get(lease_key)
+        if current_flight is not None:
+            flight = force_text(current_flight)
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        result = func()
+        redis.set(RESULT_KEY % (key, token), json.dumps(result, separators=',:'),
+                  ex=result_ttl)
+        return False, result
+    finally:
+        redis.register_script(RELEASE_SCRIPT)(keys=[lease_key], args=[token])
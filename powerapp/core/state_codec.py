@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage format for serialized Todoist API states.
+
+States are stored as a version byte followed by the payload encoded with the
+codec of this version. The only codec we have so far is zlib-compressed
+JSON, but new codecs can be added to the `CODECS` registry under new
+versions, and states encoded with old codecs can still be read.
+
+`CompressedStateField` keeps states in the database. Values loaded from the
+database are wrapped with `EncodedState` and aren't decoded until someone
+really needs them, so loading the model for a code path which doesn't work
+with the API state is cheap.
+"""
+import json
+import zlib
+from django.db import models
+from django.utils.encoding import force_bytes, force_text
+
+
+class ZlibJsonCodec(object):
+    """
+    JSON compressed with zlib. The state has to be a JSON-serializable object
+    """
+    level = 6
+
+    def encode(self, data):
+        return zlib.compress(force_bytes(json.dumps(data, separators=',:')),
+                             self.level)
+
+    def decode(self, payload):
+        return json.loads(force_text(zlib.decompress(payload)))
+
+
+CODECS = {
+    1: ZlibJsonCodec(),
+}
+DEFAULT_VERSION = 1
+
+
+def encode(data, version=DEFAULT_VERSION):
+    return bytes([version]) + CODECS[version].encode(data)
+
+
+def decode(raw):
+    raw = bytes(raw)
+    try:
+        codec = CODECS[raw[0]]
+    except (IndexError, KeyError):
+        raise ValueError('Unknown API state format')
+    return codec.decode(raw[1:])
+
+
+class EncodedState(object):
+    """
+    The API state loaded from the database. The state is decoded only when
+    someone asks for it, and every call returns a fresh copy of the data
+    """
+
+    def __init__(self, raw):
+        self.raw = bytes(raw)
+
+    def decode(self):
+        return decode(self.raw)
+
+    def __repr__(self):
+        return '<%s(%d bytes)>' % (self.__class__.__name__, len(self.raw))
+
+
+class CompressedStateField(models.BinaryField):
+    """
+    Model field to store API states in a compact format. Accepts plain
+    JSON-serializable objects and EncodedState instances (which are saved
+    back without re-encoding)
+    """
+
+    def from_db_value(self, value, expression, connection, context):
+        if value is None:
+            return None
+        return EncodedState(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, EncodedState):
+            value = value.raw
+        elif value is not None and not isinstance(value, (bytes, memoryview)):
+            value = encode(value)
+        return super(CompressedStateField, self).get_db_prep_value(value, connection, prepared)
@@ -1,21 +1,122 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
 from logging import getLogger
+from threading import local
 
+from django.db import transaction
+from django.db.models import F
+from django.utils.encoding import force_bytes
 from django.utils.timezone import now
 from django.conf import settings
 
 import todoist
+from todoist import models
 from django_statsd.clients import statsd
+from powerapp.core import http_session, single_flight, state_codec
 from powerapp.core.exceptions import return_or_raise
+from powerapp.core.logging_utils import ctx
+from powerapp.core.state_codec import EncodedState
 
 logger = getLogger(__name__)
 
 
+# keys of the sync result we emit signals for
+SYNC_RESULT_KEYS = ['Items', 'Notes', 'Projects']
+
+# keys of the state containing lists of model objects
+STATE_MODEL_KEYS = ['Filters', 'Items', 'Labels', 'LiveNotifications', 'Notes',
+                    'ProjectNotes', 'Projects', 'Reminders']
+
+
 class TodoistAPI(todoist.TodoistAPI):
 
+    # if True, commands can be deferred by `command_batch`
+    batch_commands = False
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Restore the API object from the serialized state. The state is either
+        the EncodedState, loaded from the database, or a plain dict
+        """
+        if isinstance(data, EncodedState):
+            data = data.decode()
+        obj = super(TodoistAPI, cls).deserialize(data)
+        obj.state = dict(obj.state)
+        for key in STATE_MODEL_KEYS:
+            model = getattr(models, key[:-1])
+            obj.state[key] = [o if isinstance(o, models.Model) else model(o, obj)
+                              for o in obj.state.get(key) or []]
+        return obj
+
+    def serialize(self):
+        """
+        Serialize the state to plain JSON-serializable data
+        """
+        data = super(TodoistAPI, self).serialize()
+        data['state'] = dict(data['state'])
+        for key in STATE_MODEL_KEYS:
+            data['state'][key] = [o.data if isinstance(o, models.Model) else o
+                                  for o in self.state.get(key) or []]
+        return data
+
+    def _get(self, call, url=None, **kwargs):
+        return self._request('get', call, url, **kwargs)
+
+    def _post(self, call, url=None, **kwargs):
+        return self._request('post', call, url, **kwargs)
+
+    def _request(self, method, call, url=None, **kwargs):
+        """
+        Send the request with the shared pooled session (see
+        `powerapp.core.http_session`), and return the JSON object received
+        (if any), or whatever answer we got otherwise
+        """
+        if not url:
+            url = self.get_api_url()
+        response = http_session.request(method, url + call, call, **kwargs)
+        try:
+            return response.json()
+        except ValueError:
+            return response.text
+
+    def commit(self, defer=True):
+        """
+        Commit queued commands. Within the `command_batch` context commands
+        of stateless API objects are sent later on, along with commands of
+        other API objects with the same token, and the method returns None.
+        Pass `defer=False` to send them right away (say, to get real ids of
+        new objects).
+        """
+        batch = get_command_batch()
+        if defer and self.batch_commands and batch is not None:
+            batch.add(self)
+            return None
+        return super(TodoistAPI, self).commit()
+
+    def get_sync_digest(self, sync_kwargs):
+        """
+        Return the digest of the sync request without commands. Requests
+        with the same digest get the same response from Todoist
+        """
+        resource_types = sync_kwargs.get('resource_types')
+        request = [self.token, resource_types, self._get_seq_no(resource_types)]
+        return hashlib.md5(force_bytes(json.dumps(request))).hexdigest()
+
+    def update_local_state(self, result, resource_types=None):
+        """
+        Update the local state with the result of the sync request, made by
+        someone else
+        """
+        self._update_state(result)
+        self._update_seq_no(result.get('seq_no'), result.get('seq_no_global'),
+                            resource_types)
+
     @contextmanager
     def autocommit(self):
         yield
@@ -45,8 +146,9 @@ class UserTodoistAPI(TodoistAPI):
 
         :param powerapp.core.models.Integration integration: the integration object
         """
-        if user_obj.api_state:
-            obj = cls.deserialize(user_obj.api_state)
+        api_state = user_obj.api_state or user_obj.api_state_pickled
+        if api_state:
+            obj = cls.deserialize(api_state)
         else:
             obj = cls(user_obj.api_token)
         obj.api_endpoint = settings.API_ENDPOINT
@@ -54,14 +156,31 @@ class UserTodoistAPI(TodoistAPI):
         return obj
 
     def sync(self, commands=None, **kwargs):
-        start_time = time.time()
-        new_state = super(UserTodoistAPI, self).sync(commands, **kwargs)
-        self._save_statsd(start_time)
-        return_or_raise(new_state)
+        """
+        Sync user data. Concurrent syncs of the same user with the same
+        sequence numbers share one request (the result is saved by the
+        caller who made it)
+        """
+        def request_sync():
+            start_time = time.time()
+            result = super(UserTodoistAPI, self).sync(commands, **kwargs)
+            self._save_statsd(start_time)
+            return return_or_raise(result)
+
+        if commands:
+            new_state = request_sync()
+        else:
+            key = 'user-%s-%s' % (self.user_obj.id, self.get_sync_digest(kwargs))
+            shared, new_state = single_flight.run(key, request_sync)
+            if shared:
+                self.update_local_state(new_state, kwargs.get('resource_types'))
+                return new_state
 
         self.user_obj.api_state = self.serialize()
+        self.user_obj.api_state_pickled = None
         self.user_obj.api_last_sync = now()
-        self.user_obj.save(update_fields=['api_state', 'api_last_sync'])
+        self.user_obj.save(update_fields=['api_state', 'api_state_pickled',
+                                          'api_last_sync'])
 
         return new_state
 
@@ -78,6 +197,7 @@ class StatelessTodoistAPI(TodoistAPI):
     """
     A "stateless" subclass of the standard Todoist API
     """
+    batch_commands = True
     integration = None
 
     @classmethod
@@ -137,13 +257,130 @@ class StatelessTodoistAPI(TodoistAPI):
                     setattr(obj, method_name, stub)
 
 
+_batch_local = local()
+
+
+def get_command_batch():
+    """
+    Return the active CommandBatch of the current thread, or None
+    """
+    return getattr(_batch_local, 'batch', None)
+
+
+@contextmanager
+def command_batch():
+    """
+    A context manager to accumulate commands committed by stateless API
+    objects, and send them at the end, in one sync request per token.
+    Nested contexts join the outer one.
+
+    Commands aren't sent if the block raises an exception.
+    """
+    batch = get_command_batch()
+    if batch is not None:
+        yield batch
+        return
+
+    batch = _batch_local.batch = CommandBatch()
+    try:
+        yield batch
+    finally:
+        _batch_local.batch = None
+    batch.flush()
+
+
+class CommandBatch(object):
+    """
+    Commands of stateless API objects, waiting to be sent. See
+    `command_batch` for details
+    """
+
+    def __init__(self):
+        # token -> API objects with deferred commands
+        self.apis = OrderedDict()
+        # token -> deferred commands
+        self.commands = OrderedDict()
+        self.callbacks = []
+
+    def add(self, api):
+        """
+        Move commands from the queue of the API object to the batch
+        """
+        if api.queue:
+            self.apis.setdefault(api.token, OrderedDict())[id(api)] = api
+            self.commands.setdefault(api.token, []).extend(api.queue)
+            del api.queue[:]
+
+    def on_flush(self, callback):
+        """
+        Add the callback to call once commands are sent. The callback gets
+        the dict mapping temp ids of new objects to their real ids
+        """
+        self.callbacks.append(callback)
+
+    def flush(self):
+        """
+        Send accumulated commands, one sync request per token. Real ids of new
+        objects are passed to API objects which created them (so that
+        objects in their local states get real ids), and to callbacks.
+
+        Return the dict mapping temp ids to real ids
+        """
+        temp_id_mapping = {}
+        for token, apis in self.apis.items():
+            apis = list(apis.values())
+            commands = self.commands[token]
+            statsd.incr('core.sync.batched_commands.cnt', len(commands))
+            try:
+                result = return_or_raise(apis[0].sync(commands=commands))
+            except Exception:
+                with ctx(integration=apis[0].integration):
+                    logger.exception('Unable to send batched commands')
+                continue
+
+            for uuid, status in (result.get('SyncStatus') or {}).items():
+                if status != 'ok':
+                    logger.error('Batched command %s failed: %r', uuid, status)
+            for temp_id, new_id in (result.get('TempIdMapping') or {}).items():
+                temp_id_mapping[temp_id] = new_id
+                for api in apis:
+                    api.temp_ids[temp_id] = new_id
+                    api._replace_temp_id(temp_id, new_id)
+
+        self.apis.clear()
+        self.commands.clear()
+        for callback in self.callbacks:
+            callback(temp_id_mapping)
+        return temp_id_mapping
+
+
 class StatefulTodoistAPI(TodoistAPI):
     """
     A "stateful" subclass of the standard Todoist API. The difference is that
     it automatically saves its state internally on every sync command, can
     be initialized from the Integration object and also emits sync events.
+
+    Along with the state we keep track of ids of known objects, to tell
+    new objects from updated ones without copying the whole state on every
+    sync. For every known object we also keep the fingerprint of fields
+    receivers care about (see `settings.SYNC_FINGERPRINT_FIELDS`), and don't
+    emit "updated" signals if none of these fields changed.
+
+    The state is stored in two parts: `Integration.api_state` keeps the
+    "header" (sequence numbers, temp ids and everything but objects), and
+    every object of the state is a separate `StateObject` row along with
+    its fingerprint. After the sync we write only the objects which were
+    changed, and the header, if it changed. Objects are loaded only when
+    someone needs them (see `LazyObjectState`), and known ids only when the
+    sync brings some objects, so that syncs without changes don't read or
+    write any of them.
     """
+    _serialize_fields = TodoistAPI._serialize_fields + ('known_ids', )
+
     integration = None
+    known_ids = None
+    # False if objects of the state haven't been saved as StateObject rows yet
+    objects_saved = False
 
     @classmethod
     def create(cls, integration):
@@ -152,59 +389,405 @@ class StatefulTodoistAPI(TodoistAPI):
 
         :param powerapp.core.models.Integration integration: the integration object
         """
-        if integration.api_state:
-            obj = cls.deserialize(integration.api_state)
+        api_state = integration.api_state or integration.api_state_pickled
+        if isinstance(api_state, EncodedState):
+            api_state = api_state.decode()
+        if api_state:
+            obj = cls.deserialize(api_state)
         else:
             obj = cls(integration.user.api_token)
         obj.api_endpoint = settings.API_ENDPOINT
         obj.integration = integration
+        if api_state and api_state.get('state_format') == 'objects':
+            obj.state = LazyObjectState(obj.state, obj.load_state_objects)
+            obj.objects_saved = True
         return obj
 
-    def sync(self, commands=None, **kwargs):
-        current_state = deepcopy(self.state)
-        start_time = time.time()
-        new_state = super(StatefulTodoistAPI, self).sync(commands, **kwargs)
-        _save_integration_statsd(self.integration, start_time)
-        return_or_raise(new_state)
+    @classmethod
+    def deserialize(cls, data):
+        obj = super(StatefulTodoistAPI, cls).deserialize(data)
+        if obj.known_ids is not None:
+            # known ids were serialized as lists of ids before we started to
+            # keep fingerprints, and as lists of [id, fingerprint] pairs after
+            obj.known_ids = {key: dict(item if isinstance(item, list) else (item, None)
+                                       for item in ids)
+                             for key, ids in obj.known_ids.items()}
+        return obj
+
+    def serialize(self):
+        data = super(StatefulTodoistAPI, self).serialize()
+        data['known_ids'] = self.serialize_known_ids()
+        return data
 
-        if kwargs.pop('save_state', True):
-            self.integration.api_state = self.serialize()
-            self.integration.save(update_fields=['api_state'])
+    def serialize_known_ids(self):
+        if self.known_ids is None:
+            return None
+        return {key: [list(item) for item in ids.items()]
+                for key, ids in self.known_ids.items()}
 
-        self.emit_sync_signals(current_state, new_state)
+    def sync(self, commands=None, **kwargs):
+        """
+        Sync the integration, save the state and emit signals.
+
+        Concurrent syncs of the same integration with the same sequence
+        numbers share one request. The result is processed only by the
+        caller who made it, the rest only update their local states
+        """
+        if not self.objects_saved:
+            # known ids are built from objects of the state, and it has to be
+            # done before the sync changes them
+            self.ensure_known_ids()
+        save_state = kwargs.pop('save_state', True)
+
+        def request_sync():
+            start_time = time.time()
+            result = super(StatefulTodoistAPI, self).sync(commands, **kwargs)
+            _save_integration_statsd(self.integration, start_time)
+            return return_or_raise(result)
+
+        if commands:
+            new_state = request_sync()
+        else:
+            key = 'integration-%s-%s' % (self.integration.id,
+                                         self.get_sync_digest(kwargs))
+            shared, new_state = single_flight.run(key, request_sync)
+            if shared:
+                self.update_local_state(new_state, kwargs.get('resource_types'))
+                self.classify_sync_result(new_state)
+                return new_state
+
+        self.process_sync_result(new_state, commands, save_state=save_state)
         return new_state
 
-    def emit_sync_signals(self, api_state, result):
+    def apply_sync_result(self, result, resource_types=None):
         """
-        Process sync result and yield events, one by one
+        Apply the result of the sync request, made on behalf of another
+        integration with the same sequence numbers, as if we made the request
+        ourselves. See `sync_integrations` for details
         """
-        _exists_cache = {}
+        if not self.objects_saved:
+            self.ensure_known_ids()
+        self.update_local_state(result, resource_types)
+        self.process_sync_result(result)
 
-        def exists(state_key, obj_id):
-            if state_key not in _exists_cache:
-                _exists_cache[state_key] = {obj['id'] for obj in
-                                            api_state[state_key]}
-            return obj_id in _exists_cache[state_key]
+    def process_sync_result(self, new_state, commands=None, save_state=True):
+        """
+        Classify objects of the sync result, save the state and emit signals
+        """
+        events = self.classify_sync_result(new_state)
+
+        temp_id_mapping = new_state.get('TempIdMapping')
+        if temp_id_mapping:
+            # commit() replaces temp ids only after the sync, and we need
+            # objects we created to be saved under their real ids
+            for temp_id, new_id in temp_id_mapping.items():
+                self.temp_ids[temp_id] = new_id
+                self._replace_temp_id(temp_id, new_id)
+
+        if save_state:
+            update_fields = []
+            idle = False
+            if not commands:
+                # keep track of dormant integrations to sync them less often
+                if not any(new_state.get(key) for key in SYNC_RESULT_KEYS):
+                    idle = True
+                elif self.integration.api_idle_syncs:
+                    # the integration woke up, get back to the default period
+                    self.integration.api_idle_syncs = 0
+                    self.integration.api_next_sync = None
+                    update_fields += ['api_idle_syncs', 'api_next_sync']
+            with transaction.atomic():
+                if self.save_state(new_state):
+                    update_fields += ['api_state', 'api_state_pickled']
+                if update_fields:
+                    self.integration.save(update_fields=update_fields)
+                if idle:
+                    # increment in the database, so that we don't overwrite
+                    # the reset made by the webhook handler in the meantime
+                    (type(self.integration).objects
+                     .filter(id=self.integration.id)
+                     .update(api_idle_syncs=F('api_idle_syncs') + 1))
+                    self.integration.api_idle_syncs += 1
+
+        self.emit_sync_signals(events)
+
+    def serialize_header(self):
+        """
+        Serialize everything but objects of the state
+        """
+        data = {key: getattr(self, key)
+                for key in todoist.TodoistAPI._serialize_fields}
+        data['state'] = {key: value for key, value in self.state.items()
+                         if key not in STATE_MODEL_KEYS}
+        data['state_format'] = 'objects'
+        return data
+
+    def load_state_objects(self):
+        for key in STATE_MODEL_KEYS:
+            self.state[key] = []
+        for resource, data in self.integration.state_objects.values_list('resource', 'data'):
+            model = getattr(models, resource[:-1])
+            self.state[resource].append(model(data.decode(), self))
+
+    def save_state(self, result):
+        """
+        Save the state after the sync. Only objects of the sync result are
+        written to the database, unless the state has never been saved
+        object by object before (then we write them all).
 
+        Doesn't save the integration object itself. Return True if the
+        header of the state changed, and the integration has to be saved.
+        """
+        if self.objects_saved:
+            self.save_changed_objects(result)
+        else:
+            self.save_all_objects()
+
+        raw_header = state_codec.encode(self.serialize_header())
+        old_header = self.integration.api_state
+        if (isinstance(old_header, EncodedState) and not self.integration.api_state_pickled
+                and state_codec.decode(raw_header) == old_header.decode()):
+            return False
+        self.integration.api_state = EncodedState(raw_header)
+        self.integration.api_state_pickled = None
+        return True
+
+    def save_changed_objects(self, result):
+        changed = {}
+        for key in STATE_MODEL_KEYS:
+            for obj in result.get(key) or []:
+                changed.setdefault(key, set()).add(get_object_key(key, obj))
+
+        # objects we created ourselves are saved under their real ids (temp
+        # ids are replaced by `process_sync_result`), and whatever was saved
+        # under their temp ids is deleted
+        stale = {}
+        temp_id_mapping = result.get('TempIdMapping')
+        if temp_id_mapping:
+            for key in STATE_MODEL_KEYS:
+                for obj in self.state[key]:
+                    if obj.temp_id in temp_id_mapping:
+                        changed.setdefault(key, set()).add(get_object_key(key, obj))
+                        stale.setdefault(key, set()).add(obj.temp_id)
+
+        state_objects = self.integration.state_objects
+        new_rows = []
+        for key, object_keys in changed.items():
+            state_objects.filter(resource=key,
+                                 object_key__in=object_keys | stale.get(key, set())).delete()
+            for obj in self.state[key]:
+                object_key = get_object_key(key, obj)
+                if object_key in object_keys:
+                    new_rows.append(state_objects.model(integration=self.integration,
+                                                        resource=key,
+                                                        object_key=object_key,
+                                                        data=obj.data,
+                                                        fingerprint=get_row_fingerprint(key, obj)))
+        state_objects.model.objects.bulk_create(new_rows)
+
+    def save_all_objects(self):
+        state_objects = self.integration.state_objects
+        state_objects.all().delete()
+        state_objects.model.objects.bulk_create([
+            state_objects.model(integration=self.integration,
+                                resource=key,
+                                object_key=get_object_key(key, obj),
+                                data=obj.data,
+                                fingerprint=get_row_fingerprint(key, obj))
+            for key in STATE_MODEL_KEYS for obj in self.state[key]
+        ])
+        self.objects_saved = True
+
+    def ensure_known_ids(self):
+        """
+        Make sure we have known object ids with their fingerprints. If the
+        state is saved object by object, they're read from `StateObject`
+        rows (without their data), otherwise they're built from objects of
+        the state
+        """
+        if self.known_ids is not None:
+            return
+        if self.objects_saved:
+            self.known_ids = {key: {} for key in SYNC_RESULT_KEYS}
+            rows = (self.integration.state_objects
+                    .filter(resource__in=SYNC_RESULT_KEYS)
+                    .values_list('resource', 'object_key', 'fingerprint'))
+            for resource, object_key, fingerprint in rows:
+                object_id = int(object_key) if object_key.isdigit() else object_key
+                # rows saved before we started to keep fingerprints have none
+                self.known_ids[resource][object_id] = fingerprint or None
+        else:
+            self.known_ids = {key: {obj['id']: get_fingerprint(key, obj)
+                                    for obj in self.state[key]}
+                              for key in SYNC_RESULT_KEYS}
+
+    def classify_sync_result(self, result):
+        """
+        Process sync result, update known ids, and return the list of
+        (event_name, obj) tuples. Objects which were updated, but whose
+        fingerprints didn't change, are skipped
+        """
         result_event_map = [
             ('Items', 'task'),
             ('Notes', 'note'),
             ('Projects', 'project'),
         ]
+        if not (result.get('TempIdMapping')
+                or any(result.get(key) for key in SYNC_RESULT_KEYS)):
+            return []
+        self.ensure_known_ids()
 
+        events = []
+        unchanged = 0
         for result_key, event_type in result_event_map:
+            known_ids = self.known_ids[result_key]
             for obj in result.get(result_key) or []:
                 if obj['is_deleted']:
                     event_name = 'todoist_%s_deleted' % event_type
-                elif exists(result_key, obj['id']):
+                    known_ids.pop(obj['id'], None)
+                elif obj['id'] in known_ids:
+                    fingerprint = get_fingerprint(result_key, obj)
+                    if known_ids[obj['id']] == fingerprint:
+                        unchanged += 1
+                        continue
                     event_name = 'todoist_%s_updated' % event_type
+                    known_ids[obj['id']] = fingerprint
                 else:
                     event_name = 'todoist_%s_added' % event_type
-
-                signal_obj = self.integration.app_config.signals[event_name]
+                    known_ids[obj['id']] = get_fingerprint(result_key, obj)
+                events.append((event_name, obj))
+        if unchanged:
+            statsd.incr('core.sync.unchanged_updates', unchanged)
+
+        # objects we added ourselves become known once they get their real ids
+        temp_id_mapping = result.get('TempIdMapping')
+        if temp_id_mapping:
+            for result_key in SYNC_RESULT_KEYS:
+                for obj in self.state[result_key]:
+                    if obj.temp_id in temp_id_mapping:
+                        self.known_ids[result_key][temp_id_mapping[obj.temp_id]] = \
+                            get_fingerprint(result_key, obj)
+
+        return events
+
+    def emit_sync_signals(self, events):
+        """
+        Emit signals for classified sync events, one by one
+        """
+        signals = self.integration.app_config.signals
+        for event_name, obj in events:
+            signal_obj = signals[event_name]
+            if signal_obj.has_listeners():
                 signal_obj.fire(self.integration, obj)
 
 
+class LazyObjectState(dict):
+    """
+    The state of the API, whose objects are loaded from `StateObject` rows
+    on the first access to any of `STATE_MODEL_KEYS`
+    """
+
+    def __init__(self, data, loader):
+        super(LazyObjectState, self).__init__((key, value) for key, value in data.items()
+                                              if key not in STATE_MODEL_KEYS)
+        self.loader = loader
+
+    def __missing__(self, key):
+        if key not in STATE_MODEL_KEYS or self.loader is None:
+            raise KeyError(key)
+        loader, self.loader = self.loader, None
+        loader()
+        return self[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def sync_integrations(integrations, resource_types=None, siblings=()):
+    """
+    Sync stateful integrations, sharing Todoist sync requests between them.
+
+    Integrations with the same token and the same sequence numbers get the
+    same response from Todoist. This is usually the case for integrations of
+    the same user, which were synced together before. We send one request on
+    behalf of the first integration of the group, and apply its result to
+    the rest of the group.
+
+    `siblings` are integrations which aren't due yet. They join the sync if
+    they're in the group with some of `integrations`, and are skipped
+    otherwise.
+
+    Errors are logged, and don't affect other integrations. Return the list
+    of siblings which were synced.
+    """
+    groups = OrderedDict()
+    for integration in list(integrations) + list(siblings):
+        with ctx(user=integration.user, integration=integration):
+            try:
+                api = integration.api
+            except Exception:
+                logger.exception('Unable to restore the API state')
+                continue
+        key = (api.token, api._get_seq_no(resource_types))
+        groups.setdefault(key, []).append(integration)
+
+    sibling_ids = {integration.id for integration in siblings}
+    synced_siblings = []
+    for group in groups.values():
+        if all(integration.id in sibling_ids for integration in group):
+            continue
+        result = None
+        for integration in group:
+            with ctx(user=integration.user, integration=integration):
+                try:
+                    if result is None:
+                        result = integration.api.sync(resource_types=resource_types)
+                    else:
+                        integration.api.apply_sync_result(deepcopy(result),
+                                                          resource_types)
+                        statsd.incr('core.sync.shared.cnt')
+                except Exception:
+                    logger.exception('Unable to sync the integration')
+                    continue
+            if integration.id in sibling_ids:
+                synced_siblings.append(integration)
+    return synced_siblings
+
+
+def get_fingerprint(state_key, obj):
+    """
+    Return the short fingerprint of object fields listed in
+    `settings.SYNC_FINGERPRINT_FIELDS` for its type
+    """
+    if isinstance(obj, models.Model):
+        obj = obj.data
+    fields = settings.SYNC_FINGERPRINT_FIELDS[state_key]
+    values = json.dumps([obj.get(field) for field in fields], sort_keys=True)
+    return hashlib.md5(force_bytes(values)).hexdigest()[:16]
+
+
+def get_row_fingerprint(state_key, obj):
+    """
+    Return the fingerprint to save along with the object of the state, or
+    the empty string, if we don't emit signals for objects of this type
+    """
+    if state_key not in SYNC_RESULT_KEYS:
+        return ''
+    return get_fingerprint(state_key, obj)
+
+
+def get_object_key(state_key, obj):
+    """
+    Return the key which identifies the object of the state
+    """
+    if state_key == 'LiveNotifications':
+        return str(obj['notification_key'])
+    return str(obj['id'])
+
+
 def _save_integration_statsd(integration, start_time):
     ms = int((time.time() - start_time) * 1000)
     statsd.incr('core.sync.cnt')
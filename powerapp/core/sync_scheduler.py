@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Redis-backed scheduler of periodic syncs for stateful integrations.
+
+The scheduler is used when `settings.SYNC_SCHEDULER` is set to "redis".
+Every stateful integration is a member of the Redis sorted set, and its
+score is the timestamp of the next sync. `Integration.save` and the webhook
+handler put the exact due time there, and the dispatcher pops due entries
+atomically, so that several dispatchers can run at once.
+
+The dispatcher runs either as a part of the `schedule_sync_tasks` Celery beat
+task, or, for the sub-second precision, as the `run_sync_scheduler`
+management command.
+"""
+import calendar
+from logging import getLogger
+from django.conf import settings
+from django.utils.encoding import force_text
+from powerapp.core.redis_utils import get_redis
+
+
+logger = getLogger(__name__)
+
+
+SCHEDULE_KEY = 'sync-schedule'
+
+# the max number of integrations to pop in one go
+POP_LIMIT = 1000
+
+
+SCHEDULE_EARLIER_SCRIPT = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[2])
+if not current or tonumber(ARGV[1]) < tonumber(current) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+
+POP_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+
+
+def enabled():
+    return settings.SYNC_SCHEDULER == 'redis'
+
+
+def schedule(schedule_items):
+    """
+    Schedule syncs for the exact due time. Accepts the list of
+    (integration_id, due_datetime) tuples
+    """
+    if not enabled() or not schedule_items:
+        return
+    args = []
+    for integration_id, due in schedule_items:
+        args += [to_timestamp(due), integration_id]
+    get_redis().execute_command('ZADD', SCHEDULE_KEY, *args)
+
+
+def schedule_earlier(integration_ids, due):
+    """
+    Move syncs of given integrations to the due time, unless they're already
+    scheduled to run before that
+    """
+    if not enabled() or not integration_ids:
+        return
+    redis = get_redis()
+    script = redis.register_script(SCHEDULE_EARLIER_SCRIPT)
+    pipe = redis.pipeline()
+    for integration_id in integration_ids:
+        script(keys=[SCHEDULE_KEY], args=[to_timestamp(due), integration_id],
+               client=pipe)
+    pipe.execute()
+
+
+def unschedule(integration_ids):
+    if not enabled() or not integration_ids:
+        return
+    get_redis().zrem(SCHEDULE_KEY, *integration_ids)
+
+
+def pop_due(now, limit=POP_LIMIT):
+    """
+    Remove integrations which are due by `now` from the schedule and return
+    the list of their ids
+    """
+    redis = get_redis()
+    script = redis.register_script(POP_DUE_SCRIPT)
+    return [int(force_text(integration_id))
+            for integration_id in script(keys=[SCHEDULE_KEY],
+                                         args=[to_timestamp(now), limit])]
+
+
+def next_due():
+    """
+    Return the timestamp of the next scheduled sync, or None, if the schedule
+    is empty
+    """
+    head = get_redis().zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+    if head:
+        return head[0][1]
+
+
+def to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
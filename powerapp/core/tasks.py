@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
 from powerapp.celery_local import app
 from powerapp.core.models.integration import Integration
-from powerapp.core import sync
+from powerapp.core.models.user import User, API_REFRESH_KEY
+from powerapp.core import sync, webhook_queue
 from powerapp.core.logging_utils import ctx
+from powerapp.core.redis_utils import get_redis
 
 
 @app.task(ignore_result=True)
@@ -18,3 +21,57 @@ def initial_stateless_sync(integration_id):
     with ctx(user=integration.user, integration=integration):
         api.sync(resource_types=['projects', 'items', 'notes'],
                  save_state=False)
+
+
+@app.task(ignore_result=True)
+def refresh_user_api(user_id):
+    """
+    Refresh the API state of the user, served stale by `User.api` in the
+    meantime
+    """
+    try:
+        try:
+            user = User.objects.get(id=user_id)
+        except User.DoesNotExist:
+            return
+        with ctx(user=user):
+            user.refresh_api(sync.UserTodoistAPI.create(user))
+    finally:
+        get_redis().delete(API_REFRESH_KEY % user_id)
+
+
+@app.task(ignore_result=True)
+def process_webhook_queue(partition):
+    """
+    Drain one partition of the queue of webhook events, accepted in the
+    async mode.
+
+    The task is scheduled with `settings.WEBHOOKS_COALESCE_WINDOW` delay, so
+    that events arrived within the window are processed (and coalesced)
+    together
+    """
+    # it's inside the function, because the webhooks view module schedules
+    # this task by itself
+    from powerapp.core.views.webhooks import handle_webhook_events
+    processed = webhook_queue.drain(partition, handle_webhook_events)
+    if processed and webhook_queue.pending(partition):
+        # either the partition is too long and we don't want to keep the
+        # worker busy for too long, or more events arrived while we were
+        # releasing the lock. Process the rest in a separate task.
+        #
+        # If nothing was processed, another consumer holds the partition,
+        # and it's up to that consumer to re-schedule itself
+        process_webhook_queue.apply_async(
+            (partition, ), countdown=settings.WEBHOOKS_COALESCE_WINDOW)
+
+
+@app.task(ignore_result=True)
+def process_webhook_queues():
+    """
+    A celery beat task to make sure no partition of the webhook queue is
+    left unattended
+    """
+    for partition in webhook_queue.partitions():
+        if webhook_queue.pending(partition):
+            process_webhook_queue.apply_async(
+                (partition, ), countdown=settings.WEBHOOKS_COALESCE_WINDOW)
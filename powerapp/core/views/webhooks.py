@@ -1,23 +1,30 @@
 import base64
 import hashlib
 import hmac
-from itertools import groupby
 import json
 import binascii
 import datetime
+import time
 from logging import getLogger
 
+from django.apps import apps
 from django.utils.encoding import force_bytes, force_text
 from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse
 from django.conf import settings
+from django_statsd.clients import statsd
+from powerapp.core import sync_scheduler, tasks, webhook_queue, webhook_routes
 from powerapp.core.app_signals import ServiceAppSignals
 from powerapp.core.models import Integration
+from powerapp.core.redis_utils import get_redis
+from powerapp.core.sync import command_batch
 
 
 FAST_SYNC_INTERVAL = datetime.timedelta(seconds=10 if settings.DEBUG else 30)
 
+DEDUP_KEY = 'webhooks-dedup-%s'
+
 
 logger = getLogger(__name__)
 
@@ -38,14 +45,38 @@ def accept(request):
         # quietly ignore invalid JSON
         return HttpResponse()
 
-    handle_stateful_integrations(data)
-    handle_stateless_integrations(data)
+    delivery_id = get_delivery_id(request, raw_data)
+    for ev in data:
+        ev['delivery_id'] = delivery_id
+
+    if settings.WEBHOOKS_ASYNC:
+        # postpone the processing, events are handled by Celery workers
+        for partition in webhook_queue.push(data):
+            tasks.process_webhook_queue.apply_async(
+                (partition, ), countdown=settings.WEBHOOKS_COALESCE_WINDOW)
+    else:
+        handle_webhook_events(data)
 
     # Empty 200 OK response is enough to mark webhook as processed
     # on the server side
     return HttpResponse()
 
 
+def handle_webhook_events(data):
+    """
+    Process the list of events from the verified webhook request
+    """
+    data, digests = drop_duplicate_events(data)
+    data = coalesce_events(data)
+    if not data:
+        return
+    routes = webhook_routes.get_routes({ev['user_id'] for ev in data})
+    handle_stateful_integrations(data, routes)
+    handle_stateless_integrations(data, routes)
+    # only handled events are marked as seen, failed ones can be redelivered
+    mark_events_seen(digests)
+
+
 def request_valid(raw_data, signature):
     """
     Helper function to test if the request is valid
@@ -60,35 +91,211 @@ def request_valid(raw_data, signature):
     return expected_signature.digest() == raw_signature
 
 
-def handle_stateful_integrations(data):
-    user_ids = {ev['user_id'] for ev in data}
-    next_sync = now() + FAST_SYNC_INTERVAL
-    Integration.objects.filter(user_id__in=user_ids,
-                               stateless=False,
-                               service_enabled=True).update(api_next_sync=next_sync)
+def get_delivery_id(request, raw_data):
+    """
+    Return the id of the webhook delivery, which is the same for all
+    redeliveries of the request.
 
+    Todoist passes it in the header. If it doesn't, the hash of the request
+    body within the dedup window is used instead
+    """
+    delivery_id = request.META.get('HTTP_X_TODOIST_DELIVERY_ID')
+    if delivery_id:
+        return delivery_id
+    window = int(time.time()) // max(settings.WEBHOOKS_DEDUP_TTL, 1)
+    return '%s-%s' % (hashlib.sha1(force_bytes(raw_data)).hexdigest(), window)
 
-def handle_stateless_integrations(data):
-    user_ids = {ev['user_id'] for ev in data}
 
-    # 1. Get all integrations
-    integrations = (Integration.objects.filter(user_id__in=user_ids,
-                                               stateless=True,
-                                               service_enabled=True)
-                    .select_related('user').order_by('user_id'))
+def drop_duplicate_events(data):
+    """
+    Todoist redelivers webhooks on timeouts. Remember digests of handled
+    events for `settings.WEBHOOKS_DEDUP_TTL` seconds (see `mark_events_seen`),
+    and drop events we've seen before.
+
+    Return the list of new events, and the list of their digests
+    """
+    if not settings.WEBHOOKS_DEDUP_TTL or not data:
+        return data, []
+
+    digests = [event_digest(ev) for ev in data]
+    seen = get_redis().mget([DEDUP_KEY % digest for digest in digests])
+    new = [(ev, digest) for ev, digest, is_seen in zip(data, digests, seen)
+           if not is_seen]
+    return [ev for ev, _ in new], [digest for _, digest in new]
+
+
+def mark_events_seen(digests):
+    """
+    Remember digests of handled events, so that their redeliveries are
+    dropped
+    """
+    if not settings.WEBHOOKS_DEDUP_TTL or not digests:
+        return
 
-    # 2. Group them by user id
-    user_integrations = {}
-    for user_id, integration_subset in groupby(integrations, lambda i: i.user_id):
-        user_integrations[user_id] = list(integration_subset)
+    pipe = get_redis().pipeline()
+    for digest in digests:
+        pipe.set(DEDUP_KEY % digest, 1, ex=settings.WEBHOOKS_DEDUP_TTL)
+    pipe.execute()
 
-    # 3. Handle events one by one
+
+def event_digest(event):
+    """
+    Return the digest of the event, which is the same for all deliveries of
+    the same event.
+
+    Along with the name of the event and the id of the object we use the id
+    of the delivery, so that subsequent updates of the object which bring
+    it to one of its previous states (say, complete -> uncomplete ->
+    complete) aren't taken for redeliveries. The version, the date and the
+    data of the event tell events of the same delivery from each other.
+    """
+    event_data = event.get('event_data') or {}
+    components = [event.get('event_name'),
+                  event.get('user_id'),
+                  event_data.get('id'),
+                  event.get('delivery_id'),
+                  event.get('version'),
+                  event.get('triggered_at'),
+                  event_data]
+    str_components = json.dumps(components, separators=',:', sort_keys=True)
+    return hashlib.sha1(force_bytes(str_components)).hexdigest()
+
+
+def coalesce_events(data):
+    """
+    Collapse events related to the same object, so that only the latest state
+    of every object is dispatched.
+
+    Objects are identified by (user id, object type, object id), and the
+    resulting events take the place of the latest event of the object. The
+    "added" event followed by updates becomes the "added" event with the
+    latest object data, and the "deleted" event always wins. Other events
+    (like "completed") keep the latest "updated" event before them, so that
+    receivers of "updated" events don't miss changes.
+    """
+    ret = []
+    positions = {}
+    for ev in data:
+        key = event_object_key(ev)
+        if key is None:
+            ret.append(ev)
+            continue
+
+        events = [ev]
+        if key in positions:
+            events = merge_events([ret[pos] for pos in positions[key]], ev)
+            for pos in positions[key]:
+                ret[pos] = None
+
+        positions[key] = list(range(len(ret), len(ret) + len(events)))
+        ret.extend(events)
+
+    ret = [ev for ev in ret if ev is not None]
+    if len(ret) < len(data):
+        statsd.incr('core.webhooks.coalesced', len(data) - len(ret))
+    return ret
+
+
+def event_object_key(event):
+    """
+    Return the key identifying the object the event is related to, or None,
+    if the event can't be coalesced with others
+    """
+    obj_id = (event.get('event_data') or {}).get('id')
+    if obj_id is None or ':' not in event.get('event_name', ''):
+        return None
+    obj = event['event_name'].split(':', 1)[0]
+    return event['user_id'], obj, obj_id
+
+
+def merge_events(prev_events, event):
+    """
+    Merge events related to the same object (which are the result of the
+    previous merge) with the next event of the object. Return the list of
+    events to dispatch instead. Events are not modified in place
+    """
+    obj, prev_action = prev_events[0]['event_name'].split(':', 1)
+    action = event['event_name'].split(':', 1)[1]
+    updated_name = '%s:updated' % obj
+    if action in ('added', 'deleted'):
+        return [event]
+    if prev_action != 'added':
+        # keep the latest update along with the latest completed, archived,
+        # etc event, in the order they were received
+        if action == 'updated':
+            kept = [ev for ev in prev_events if ev['event_name'] != updated_name]
+        else:
+            kept = [ev for ev in prev_events if ev['event_name'] == updated_name]
+        return kept + [event]
+
+    # the object was added within the window, and the receiver has to see it
+    # as a new one, but with the latest data
+    event_data = dict(event['event_data'])
+    if action == 'uncompleted':
+        event_data.update({'checked': False, 'in_history': False})
+    return [dict(event, event_name='%s:added' % obj, event_data=event_data)]
+
+
+def handle_stateful_integrations(data, routes):
+    integration_ids = set()
+    for user_id in {ev['user_id'] for ev in data}:
+        integration_ids.update(routes[user_id]['stateful'])
+    if not integration_ids:
+        return
+    next_sync = now() + FAST_SYNC_INTERVAL
+    Integration.objects.filter(id__in=integration_ids,
+                               stateless=False,
+                               service_enabled=True).update(api_next_sync=next_sync,
+                                                            api_idle_syncs=0)
+    sync_scheduler.schedule_earlier(integration_ids, next_sync)
+
+
+def handle_stateless_integrations(data, routes):
+    # 1. Convert events to signals, and find integrations which listen to them
+    signals = []
+    integration_ids = set()
     for ev in data:
         signal_name, event_data = webhook_to_django_signal(ev)
         if not signal_name:
             continue
         user_id = ev['user_id']
-        for integration in user_integrations.get(user_id, []):
+        listeners = []
+        for integration_id, service_label in routes[user_id]['stateless']:
+            try:
+                app_config = apps.get_app_config(service_label)
+            except LookupError:
+                continue
+            if app_config.signals[signal_name].has_listeners():
+                listeners.append(integration_id)
+        if listeners:
+            signals.append((signal_name, event_data, listeners))
+            integration_ids.update(listeners)
+
+    if not integration_ids:
+        return
+
+    # 2. Get all integrations we need
+    integrations = (Integration.objects.filter(id__in=integration_ids,
+                                               stateless=True,
+                                               service_enabled=True)
+                    .select_related('user'))
+    integrations = {integration.id: integration for integration in integrations}
+
+    # 3. Handle events one by one. Optionally, commands which receivers
+    # commit are sent at the end, one request per user
+    if settings.WEBHOOKS_BATCH_COMMANDS:
+        with command_batch():
+            fire_signals(signals, integrations)
+    else:
+        fire_signals(signals, integrations)
+
+
+def fire_signals(signals, integrations):
+    for signal_name, event_data, listeners in signals:
+        for integration_id in listeners:
+            integration = integrations.get(integration_id)
+            if integration is None:
+                continue
             signal = integration.app_config.signals[signal_name]
             signal.fire(integration, event_data)
 
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+A durable Redis-backed queue of incoming webhook events.
+
+When `settings.WEBHOOKS_ASYNC` is on, the webhook view only verifies the
+request and appends its events to the queue. The Celery task
+`powerapp.core.tasks.process_webhook_queue` drains the queue later on.
+
+The queue is split into `settings.WEBHOOKS_PARTITIONS` partitions. Events are
+distributed between partitions by user id with a consistent hash, and every
+partition is drained by one consumer at a time. This way events of the same
+user are always processed in the order they were received, while events of
+different users can be processed by several workers in parallel.
+
+Chunks of events which are being processed are moved to a separate
+"processing" list, and are removed from there only once they're handled. This way
+we don't lose anything if the worker dies in the middle of the work: next
+consumer of the partition moves orphaned events back to the queue first.
+"""
+import bisect
+import hashlib
+import json
+from collections import OrderedDict
+from logging import getLogger
+from django.conf import settings
+from django.utils.encoding import force_bytes, force_text
+from powerapp.core.redis_utils import get_redis
+
+
+logger = getLogger(__name__)
+
+
+QUEUE_KEY = 'webhooks-queue-%s'
+PROCESSING_KEY = 'webhooks-queue-processing-%s'
+CONSUMER_LOCK_KEY = 'webhooks-queue-consumer-%s'
+
+# no more than 5 mins per consumer run (the same as CELERYD_TASK_TIME_LIMIT)
+CONSUMER_LOCK_TIMEOUT = 60 * 5
+
+# the max number of chunks to process in one consumer run
+MAX_CHUNKS_PER_RUN = 1000
+
+# the max number of chunks to pass to the handler at once
+CHUNKS_PER_BATCH = 100
+
+
+class HashRing(object):
+    """
+    Consistent hash ring to map user ids to partitions. Every partition is
+    represented with a number of virtual nodes on the ring, so that the load
+    is evenly distributed, and changing the number of partitions moves only
+    a fraction of users to other partitions.
+    """
+
+    def __init__(self, partitions, replicas=64):
+        self.partitions = partitions
+        ring = []
+        for partition in range(partitions):
+            for replica in range(replicas):
+                ring.append((self.hash('%s-%s' % (partition, replica)), partition))
+        ring.sort()
+        self.hashes = [h for h, _ in ring]
+        self.nodes = [p for _, p in ring]
+
+    def get_partition(self, key):
+        idx = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.nodes[idx]
+
+    @staticmethod
+    def hash(key):
+        # we can't use built-in hash(), because it's randomized per process
+        digest = hashlib.md5(force_bytes(key)).hexdigest()
+        return int(digest[:16], 16)
+
+
+ring = HashRing(settings.WEBHOOKS_PARTITIONS)
+
+
+def partitions():
+    return range(ring.partitions)
+
+
+def push(events):
+    """
+    Append webhook events to the queue. Every partition receives a chunk with
+    events of its users, in the same order as they were received.
+
+    Return the list of partitions which got new events.
+    """
+    chunks = OrderedDict()
+    for ev in events:
+        partition = ring.get_partition(ev['user_id'])
+        chunks.setdefault(partition, []).append(ev)
+
+    pipe = get_redis().pipeline()
+    for partition, chunk in chunks.items():
+        pipe.lpush(QUEUE_KEY % partition, json.dumps(chunk, separators=',:'))
+    pipe.execute()
+    return list(chunks.keys())
+
+
+def pending(partition):
+    """
+    Return the number of chunks in the partition, waiting for processing
+    (including ones left by crashed consumers)
+    """
+    pipe = get_redis().pipeline()
+    pipe.llen(QUEUE_KEY % partition)
+    pipe.llen(PROCESSING_KEY % partition)
+    return sum(pipe.execute())
+
+
+def drain(partition, handler, max_chunks=MAX_CHUNKS_PER_RUN,
+          batch_size=CHUNKS_PER_BATCH):
+    """
+    Pop chunks of events from the partition in the order they were received,
+    and pass them to the handler in batches. Every batch is a list of events
+    from up to `batch_size` chunks, so that the handler can coalesce events
+    accumulated in the queue.
+
+    Only one consumer drains the partition at a time. If another consumer is
+    active, return immediately: that consumer will process our events too.
+
+    If the handler fails with the batch, chunks of the batch are passed to
+    the handler one by one. Exceptions raised then are logged, and failed
+    chunks are dropped, so that one broken chunk doesn't block the whole
+    partition, and doesn't take events of other chunks with it.
+
+    Return the number of processed chunks.
+    """
+    redis = get_redis()
+    queue_key = QUEUE_KEY % partition
+    processing_key = PROCESSING_KEY % partition
+    lock = redis.lock(CONSUMER_LOCK_KEY % partition,
+                      timeout=CONSUMER_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return 0
+
+    try:
+        requeue_orphans(redis, partition)
+        processed = 0
+        while processed < max_chunks:
+            chunks = []
+            while len(chunks) < batch_size:
+                raw_chunk = redis.rpoplpush(queue_key, processing_key)
+                if raw_chunk is None:
+                    break
+                chunks.append(json.loads(force_text(raw_chunk)))
+
+            if not chunks:
+                break
+            handle_chunks(partition, handler, chunks)
+            redis.delete(processing_key)
+            processed += len(chunks)
+        return processed
+    finally:
+        lock.release()
+
+
+def handle_chunks(partition, handler, chunks):
+    """
+    Pass events of all chunks to the handler at once, and fall back to
+    handling chunks one by one if it fails
+    """
+    try:
+        handler([ev for chunk in chunks for ev in chunk])
+        return
+    except Exception:
+        if len(chunks) == 1:
+            logger.exception('Unable to process webhook events',
+                             extra={'partition': partition})
+            return
+        logger.warning('Unable to process the batch of webhook events, '
+                       'process chunks one by one', exc_info=True,
+                       extra={'partition': partition})
+
+    for chunk in chunks:
+        try:
+            handler(chunk)
+        except Exception:
+            logger.exception('Unable to process webhook events',
+                             extra={'partition': partition})
+
+
+def requeue_orphans(redis, partition):
+    """
+    Move chunks left by a crashed consumer back to the queue, so that they
+    are processed first. Has to be called with the consumer lock acquired.
+    """
+    while True:
+        raw_chunk = redis.lpop(PROCESSING_KEY % partition)
+        if raw_chunk is None:
+            break
+        logger.warning('Requeue orphaned webhook events',
+                       extra={'partition': partition})
+        redis.rpush(QUEUE_KEY % partition, raw_chunk)
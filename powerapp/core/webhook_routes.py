@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+The Redis-backed routing index for webhook events.
+
+For every user we keep the list of enabled stateless integrations (along
+with their service labels) and the list of ids of enabled stateful
+integrations. This way webhooks of users without integrations don't
+issue any SQL queries at all, and for the rest of users we load only those
+integrations which have receivers for incoming events.
+
+Routes are invalidated by `post_save` and `post_delete` receivers in
+`powerapp.core.signals`. As receivers are called before the transaction is
+committed, routes expire after `ROUTES_TTL` anyway.
+"""
+import json
+from django.utils.encoding import force_text
+from powerapp.core.models import Integration
+from powerapp.core.redis_utils import get_redis
+
+
+ROUTES_KEY = 'webhooks-routes-%s'
+ROUTES_TTL = 60 * 5
+
+
+def get_routes(user_ids):
+    """
+    Return the dict with routes for every user id. Every route is a dict like
+
+        {'stateless': [[integration_id, service_label], ...],
+         'stateful': [integration_id, ...]}
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+
+    redis = get_redis()
+    routes = {}
+    missing = []
+    for user_id, raw_route in zip(user_ids, redis.mget([ROUTES_KEY % user_id
+                                                        for user_id in user_ids])):
+        if raw_route is None:
+            missing.append(user_id)
+        else:
+            routes[user_id] = json.loads(force_text(raw_route))
+
+    if missing:
+        missing_routes = build_routes(missing)
+        pipe = redis.pipeline()
+        for user_id, route in missing_routes.items():
+            pipe.set(ROUTES_KEY % user_id, json.dumps(route, separators=',:'),
+                     ex=ROUTES_TTL)
+        pipe.execute()
+        routes.update(missing_routes)
+
+    return routes
+
+
+def build_routes(user_ids):
+    """
+    Build routes for users from the database
+    """
+    routes = {user_id: {'stateless': [], 'stateful': []}
+              for user_id in user_ids}
+    integrations = (Integration.objects
+                    .filter(user_id__in=user_ids, service_enabled=True)
+                    .values_list('id', 'user_id', 'service_id', 'stateless'))
+    for integration_id, user_id, service_id, stateless in integrations:
+        if stateless:
+            routes[user_id]['stateless'].append([integration_id, service_id])
+        else:
+            routes[user_id]['stateful'].append(integration_id)
+    return routes
+
+
+def invalidate(*user_ids):
+    if user_ids:
+        get_redis().delete(*[ROUTES_KEY % user_id for user_id in user_ids])
@@ -27,6 +27,19 @@ env = environ.Env(
     # graylog default settings
     GRAYLOG2_HOST=(str, None),
     GRAYLOG2_PORT=(int, 12201),
+    # webhooks default settings
+    WEBHOOKS_ASYNC=(bool, False),
+    WEBHOOKS_PARTITIONS=(int, 16),
+    WEBHOOKS_DEDUP_TTL=(int, 3600),
+    WEBHOOKS_COALESCE_WINDOW=(int, 2),
+    WEBHOOKS_BATCH_COMMANDS=(bool, False),
+    # sync scheduler default settings
+    SYNC_SCHEDULER=(str, 'database'),
+    # user API default settings
+    USER_API_STALE_WHILE_REVALIDATE=(bool, False),
+    # Todoist API client default settings
+    TODOIST_HTTP_POOL_SIZE=(int, 10),
+    TODOIST_HTTP_TIMEOUT=(float, 30),
 )
 env.read_env('.env')
 
@@ -149,6 +162,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'powerapp.core.cron.schedule_cron_tasks',
         'schedule': timedelta(minutes=2),
     },
+    'process_webhook_queues': {
+        'task': 'powerapp.core.tasks.process_webhook_queues',
+        'schedule': timedelta(minutes=1),
+    },
 }
 CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'
 
@@ -176,6 +193,49 @@ TODOIST_CLIENT_ID = env('TODOIST_CLIENT_ID')
 TODOIST_CLIENT_SECRET = env('TODOIST_CLIENT_SECRET')
 GOOGLE_SITE_VERIFICATION = env('GOOGLE_SITE_VERIFICATION')
 
+# If True, webhooks view only verifies incoming requests and appends them to
+# the Redis queue. Payloads are processed later on by Celery workers
+WEBHOOKS_ASYNC = env('WEBHOOKS_ASYNC')
+# The number of partitions of the webhook queue. Events of one user always
+# get to the same partition, and are processed in order
+WEBHOOKS_PARTITIONS = env('WEBHOOKS_PARTITIONS')
+# For how long (in seconds) we remember seen webhook events to drop ones
+# redelivered by Todoist. Set to 0 to turn the deduplication off
+WEBHOOKS_DEDUP_TTL = env('WEBHOOKS_DEDUP_TTL')
+# In the async mode, for how long (in seconds) we accumulate events before
+# processing them. Updates of the same object within the window are
+# collapsed, and only the latest state of the object is dispatched
+WEBHOOKS_COALESCE_WINDOW = env('WEBHOOKS_COALESCE_WINDOW')
+# If True, commands which stateless integrations commit while handling
+# webhook events are sent at the end, in one sync request per user
+WEBHOOKS_BATCH_COMMANDS = env('WEBHOOKS_BATCH_COMMANDS')
+
+# The way we schedule periodic syncs of stateful integrations. Either
+# "database" (Celery beat scans the table of integrations) or "redis" (due
+# times are kept in the Redis sorted set, see powerapp.core.sync_scheduler)
+SYNC_SCHEDULER = env('SYNC_SCHEDULER')
+
+# Fields of objects which receivers of "updated" sync signals care about.
+# If none of them changed, the signal isn't emitted
+SYNC_FINGERPRINT_FIELDS = {
+    'Items': ['content', 'project_id', 'checked', 'in_history', 'is_archived',
+              'priority', 'indent', 'item_order', 'due_date', 'due_date_utc',
+              'date_string', 'labels', 'responsible_uid'],
+    'Notes': ['content', 'item_id', 'project_id', 'file_attachment',
+              'is_archived'],
+    'Projects': ['name', 'color', 'indent', 'item_order', 'is_archived',
+                 'shared'],
+}
+
+# If True, outdated personal data of users are served as is, and refreshed
+# in background, instead of blocking the request until Todoist responds
+USER_API_STALE_WHILE_REVALIDATE = env('USER_API_STALE_WHILE_REVALIDATE')
+
+# The max number of keep-alive connections to Todoist every process keeps
+TODOIST_HTTP_POOL_SIZE = env('TODOIST_HTTP_POOL_SIZE')
+# The timeout (in seconds) of requests to Todoist API
+TODOIST_HTTP_TIMEOUT = env('TODOIST_HTTP_TIMEOUT')
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
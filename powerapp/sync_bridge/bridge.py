@@ -8,8 +8,10 @@ import json
 import datetime
 from email.utils import parsedate
 from logging import getLogger
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager, ExitStack
 from django.utils.encoding import force_bytes, force_text
+from django_statsd.clients import statsd
 from .models import ItemMapping
 from powerapp.core.logging_utils import ctx
 from powerapp.core.redis_utils import get_redis
@@ -20,6 +22,12 @@ logger = getLogger(__name__)
 TASK_FIELDS = ['checked', 'content', 'date_string', 'due_date', 'in_history',
                'indent', 'item_order', 'priority', 'tags']
 
+# tasks declined by the target side are remembered for a day, see
+# `SyncBridge.is_task_declined`
+DECLINED_KEY = 'sync-bridge-declined-%s-%s-%s-%s'
+DECLINED_TTL = 60 * 60 * 24
+DECLINED_HASH_LENGTH = 16
+
 
 class SyncBridge(object):
     """
@@ -51,13 +59,20 @@ class SyncBridge(object):
 
         The function has to be called whenever a user creates or updates a
         task.
+
+        Most pushes are echoes of our own changes, or tasks which didn't
+        change, so first we compare hashes without taking the lock. The lock
+        is taken only if the task has to be pushed, and hashes are compared
+        once again under the lock. Tasks recently declined by the target are
+        skipped even before that, see `is_task_declined`.
         """
-        with self.lock_and_ctx():
+        if self.is_task_declined(source, task_id, data):
+            return
+        if self.is_task_unchanged(source, task_id, data):
+            return
 
-            source, target, source_side, target_side = self.find_direction(source)
-            mapping = self.get_mapping_by_task_id(source_side, task_id)
-            if not mapping:
-                mapping = self.create_mapping_by_task_id(source_side, task_id)
+        source, target, source_side, target_side = self.find_direction(source)
+        with self.lock_mapping(source_side, task_id, create=True) as mapping:
 
             # create a new task from the data
             source_extra = mapping.side(source_side).extra
@@ -74,9 +89,7 @@ class SyncBridge(object):
             logging_extra = {'source': source, 'target': target,
                              'mapping': mapping, 'task': task}
 
-            mapping_source_hash = mapping.side(source_side).hash
-            mapping_target_hash = mapping.side(target_side).hash
-            if mapping_source_hash == source_hash or mapping_target_hash == target_hash:
+            if hashes_match(mapping, source_side, target_side, source_hash, target_hash):
                 logger.debug('%s refuses to send a task %s (hashes match)',
                              source, task_id, extra=logging_extra)
                 return
@@ -95,10 +108,184 @@ class SyncBridge(object):
                 # save hashes
                 mapping.side(source_side).hash = source_hash
                 mapping.side(target_side).hash = target_hash
-                mapping.save()
+                if mapping.id:
+                    mapping.save()
+                else:
+                    ItemMapping.objects.upsert(mapping, source_side)
+                self.forget_declined_tasks(source_side, [task_id])
             else:
                 # the receiver part is not interested in this task
-                mapping.delete()
+                if mapping.id:
+                    mapping.delete()
+                self.remember_declined_tasks(source_side, [(task_id, target_hash)])
+
+    def push_tasks(self, source, tasks):
+        """
+        Pass a batch of tasks through the bridge. Works like `push_task`, but
+        accepts the list of (task_id, data) tuples, loads their mappings in
+        one query, and passes tasks to the target adapter in one call of its
+        `push_tasks` method.
+
+        The function is meant for adapters which get many changes at once
+        (say, while syncing the third-party service).
+        """
+        source, target, source_side, target_side = self.find_direction(source)
+        tasks = OrderedDict((force_text(task_id), data) for task_id, data in tasks)
+        for task_id in self.get_declined_task_ids(source, list(tasks.items())):
+            del tasks[task_id]
+        if not tasks:
+            return
+
+        # lock-free pre-check, see `push_task` for details
+        mappings = self.get_mappings_by_task_ids(source_side, list(tasks))
+        changed_ids = [task_id for task_id, data in tasks.items()
+                       if task_id not in mappings
+                       or self.prepare_push(source, target, source_side, target_side,
+                                            mappings[task_id], data)]
+        if not changed_ids:
+            return
+
+        with self.lock_mappings(source_side, changed_ids, create=True) as mappings:
+            pushes = []
+            for task_id in changed_ids:
+                mapping = mappings.get(task_id)
+                if mapping is None:
+                    continue
+                push = self.prepare_push(source, target, source_side, target_side,
+                                         mapping, tasks[task_id])
+                if push:
+                    pushes.append((mapping, ) + push)
+            if not pushes:
+                return
+
+            logger.debug('%s pushes %d tasks', source, len(pushes),
+                         extra={'source': source, 'target': target})
+            results = target.push_tasks([(mapping.side(target_side).id, task,
+                                          mapping.side(target_side).extra)
+                                         for mapping, task, _, _ in pushes])
+
+            updated, accepted, declined = [], [], []
+            for (mapping, task, source_hash, target_hash), (new_target_id, new_target_extra) \
+                    in zip(pushes, results):
+                task_id = mapping.side(source_side).id
+                if new_target_id:
+                    mapping.side(target_side).id = force_text(new_target_id)
+                    mapping.side(target_side).extra = new_target_extra
+                    mapping.side(source_side).hash = source_hash
+                    mapping.side(target_side).hash = target_hash
+                    if mapping.id:
+                        updated.append(mapping)
+                    else:
+                        ItemMapping.objects.upsert(mapping, source_side)
+                    accepted.append(task_id)
+                else:
+                    # the receiver part is not interested in this task
+                    declined.append((mapping, task_id, target_hash))
+
+            ItemMapping.objects.bulk_update(updated, [
+                '%s_id' % target_side, '%s_extra' % target_side,
+                '%s_hash' % source_side, '%s_hash' % target_side,
+            ])
+            declined_ids = [mapping.id for mapping, _, _ in declined if mapping.id]
+            if declined_ids:
+                ItemMapping.objects.filter(id__in=declined_ids).delete()
+            self.forget_declined_tasks(source_side, accepted)
+            self.remember_declined_tasks(source_side, [(task_id, target_hash)
+                                                       for _, task_id, target_hash in declined])
+
+    def prepare_push(self, source, target, source_side, target_side, mapping, data):
+        """
+        Internal helper to convert data to the task, and decide whether it has
+        to be pushed. Return None if not, and the (task, source_hash,
+        target_hash) tuple otherwise
+        """
+        task = source.task_from_data(data, mapping.side(source_side).extra)
+        if task is None or is_task_undefined(task):
+            return None
+        source_hash = get_hash(task, source.ESSENTIAL_FIELDS)
+        target_hash = get_hash(task, target.ESSENTIAL_FIELDS)
+        if hashes_match(mapping, source_side, target_side, source_hash, target_hash):
+            return None
+        return task, source_hash, target_hash
+
+    def is_task_declined(self, source, task_id, data):
+        """
+        Check without touching the database that the target side has recently
+        declined the task, and the fields essential for the target haven't
+        changed since then. It costs one Redis GET, and the task conversion
+        only if the task is known as declined.
+        """
+        return bool(self.get_declined_task_ids(source, [(task_id, data)]))
+
+    def get_declined_task_ids(self, source, tasks):
+        """
+        Batch version of `is_task_declined`. Accepts the list of
+        (task_id, data) tuples, and returns the list of ids of declined tasks
+        """
+        if not tasks:
+            return []
+        source, target, source_side, target_side = self.find_direction(source)
+        keys = [self.declined_key(source_side, task_id) for task_id, _ in tasks]
+        declined = []
+        for (task_id, data), declined_hash in zip(tasks, get_redis().mget(keys)):
+            if declined_hash is None:
+                continue
+            # provisional mappings have empty extra, the same as declined
+            # tasks had when they were pushed
+            task = source.task_from_data(data, {})
+            if task is None or is_task_undefined(task):
+                continue
+            if force_text(declined_hash) == get_declined_hash(task, target):
+                declined.append(task_id)
+        if declined:
+            statsd.incr('sync_bridge.declined_skipped', len(declined))
+        return declined
+
+    def remember_declined_tasks(self, side, declined):
+        """
+        Remember tasks declined by the target side. Accepts the list of
+        (task_id, target_hash) tuples
+        """
+        if not declined:
+            return
+        pipe = get_redis().pipeline()
+        for task_id, target_hash in declined:
+            pipe.set(self.declined_key(side, task_id), target_hash[:DECLINED_HASH_LENGTH],
+                     ex=DECLINED_TTL)
+        pipe.execute()
+
+    def forget_declined_tasks(self, side, task_ids):
+        if task_ids:
+            get_redis().delete(*[self.declined_key(side, task_id) for task_id in task_ids])
+
+    def declined_key(self, side, task_id):
+        return DECLINED_KEY % (self.integration.id, self.name, side, task_id)
+
+    def is_task_unchanged(self, source, task_id, data):
+        """
+        Lock-free check that the task doesn't have to be pushed: it's known to
+        the bridge, and either undefined, or its hashes match the mapping.
+        Return False if not sure.
+        """
+        source, target, source_side, target_side = self.find_direction(source)
+        mapping = self.get_mapping_by_task_id(source_side, task_id)
+        if not mapping:
+            return False
+
+        task = source.task_from_data(data, mapping.side(source_side).extra)
+        if task is None or is_task_undefined(task):
+            return True
+
+        source_hash = get_hash(task, source.ESSENTIAL_FIELDS)
+        target_hash = get_hash(task, target.ESSENTIAL_FIELDS)
+        if hashes_match(mapping, source_side, target_side, source_hash, target_hash):
+            with ctx(integration=self.integration, user=self.integration.user):
+                logger.debug('%s refuses to send a task %s (hashes match)',
+                             source, task_id,
+                             extra={'source': source, 'target': target,
+                                    'mapping': mapping, 'task': task})
+            return True
+        return False
 
     def delete_task(self, source, task_id):
         """
@@ -110,9 +297,8 @@ class SyncBridge(object):
 
         The function has to be called whenever a user deletes a task
         """
-        with self.lock_and_ctx():
-            source, target, source_side, target_side = self.find_direction(source)
-            mapping = self.get_mapping_by_task_id(source_side, task_id)
+        source, target, source_side, target_side = self.find_direction(source)
+        with self.lock_mapping(source_side, task_id) as mapping:
             if not mapping:
                 # the task is not known to the bridge, ignore it
                 return
@@ -147,9 +333,8 @@ class SyncBridge(object):
         If `delete_mapping` is set to True, then once you uncomplete the item
         from Todoist, a new item will be created on a third-party service.
         """
-        with self.lock_and_ctx():
-            source, target, source_side, target_side = self.find_direction(source)
-            mapping = self.get_mapping_by_task_id(source_side, task_id)
+        source, target, source_side, target_side = self.find_direction(source)
+        with self.lock_mapping(source_side, task_id) as mapping:
             if not mapping:
                 # the task is not known to the bridge, ignore it
                 return
@@ -175,24 +360,111 @@ class SyncBridge(object):
 
     def get_mapping_by_task_id(self, side, task_id):
         """
-        Helper function to find the mapping, if several mappings found, use the last one
+        Helper function to find the mapping
         """
         kw = {'%s_id' % side: task_id}  # i.e. left_id: 15
-        return ItemMapping.objects.bridge_filter(self, **kw).order_by('-id').first()
+        return ItemMapping.objects.bridge_filter(self, **kw).first()
 
-    def create_mapping_by_task_id(self, side, task_id):
+    def get_mappings_by_task_ids(self, side, task_ids):
         """
-        Helper function to create a new mapping
+        Helper function to find mappings of several tasks in one query.
+        Return the dict {task_id: mapping}
         """
-        kw = {'%s_id' % side: task_id}  # i.e. left_id: 15
-        return ItemMapping.objects.bridge_create(self, **kw)
+        kw = {'%s_id__in' % side: task_ids}  # i.e. left_id__in: [15, 16]
+        mappings = ItemMapping.objects.bridge_filter(self, **kw)
+        return {mapping.side(side).id: mapping for mapping in mappings}
 
-    def lock_and_ctx(self):
+    def build_mapping_by_task_id(self, side, task_id):
         """
-        Internal function returning a "global redis lock" to make sure we
-        perform only one sync operation at a time.
+        Helper function to build a new provisional mapping. The mapping is
+        not saved until the target side accepts the task, see
+        `BridgeManager.upsert`
+        """
+        kw = {'%s_id' % side: force_text(task_id)}  # i.e. left_id: '15'
+        return ItemMapping(integration=self.integration, bridge_name=self.name, **kw)
+
+    @contextmanager
+    def lock_mapping(self, side, task_id, create=False):
+        """
+        Internal context manager to find the mapping of the task and lock it,
+        so that operations with different tasks can run in parallel. Yields
+        the mapping, or None, if the task is not known to the bridge.
+
+        If `create` is True, unknown tasks get the provisional (unsaved)
+        mapping. It's yielded under the bridge-wide creation lock, and the
+        lock has to be held until the mapping is saved: otherwise the echo of
+        the task we've just created on the target side doesn't find the
+        mapping by its target id, and comes back as a new task.
+        """
+        while True:
+            mapping = self.get_mapping_by_task_id(side, task_id)
+            if mapping:
+                with self.lock_and_ctx(mapping.id):
+                    # the mapping could be changed or deleted while we were
+                    # waiting for the lock. If it's deleted, start over
+                    mapping = ItemMapping.objects.filter(id=mapping.id).first()
+                    if mapping:
+                        yield mapping
+                        return
+                continue
+
+            if not create:
+                with ctx(integration=self.integration, user=self.integration.user):
+                    yield None
+                return
+
+            with self.lock_and_ctx():
+                # another worker could save the mapping while we were waiting
+                # for the lock. If so, start over to lock the saved one
+                if not self.get_mapping_by_task_id(side, task_id):
+                    yield self.build_mapping_by_task_id(side, task_id)
+                    return
+
+    @contextmanager
+    def lock_mappings(self, side, task_ids, create=False):
+        """
+        Internal context manager to find mappings of several tasks and lock
+        them all, see `lock_mapping`. Yields the dict {task_id: mapping}.
+
+        If `create` is True, unknown tasks get provisional mappings, and the
+        bridge-wide creation lock is held until they're saved. If mappings
+        are saved or deleted by someone else while we were waiting for
+        locks, start over to lock them in order.
+        """
+        while True:
+            mappings = self.get_mappings_by_task_ids(side, task_ids)
+            missing = [task_id for task_id in task_ids if task_id not in mappings]
+            if not create:
+                missing = []
+
+            with ExitStack() as stack:
+                # the creation lock goes first, and mappings are always locked
+                # in the same order to avoid deadlocks
+                if missing:
+                    stack.enter_context(self.lock_and_ctx())
+                    if self.get_mappings_by_task_ids(side, missing):
+                        continue
+                for mapping_id in sorted(mapping.id for mapping in mappings.values()):
+                    stack.enter_context(self.lock_and_ctx(mapping_id))
+
+                fresh = ItemMapping.objects.in_bulk([mapping.id for mapping in mappings.values()])
+                if len(fresh) < len(mappings):
+                    continue
+                locked = {task_id: fresh[mapping.id] for task_id, mapping in mappings.items()}
+                for task_id in missing:
+                    locked[task_id] = self.build_mapping_by_task_id(side, task_id)
+                yield locked
+                return
+
+    def lock_and_ctx(self, mapping_id=None):
+        """
+        Internal function returning a redis lock to make sure we perform only
+        one sync operation with the mapping at a time. Without the mapping id,
+        the lock is bridge-wide, and it's used to create new mappings.
         """
         lock_name = 'sync-bridge-%s-%s' % (self.integration.id, self.name)
+        if mapping_id is not None:
+            lock_name += '-%s' % mapping_id
         lock_timeout = 60 * 5  # no more than 5 mins per sync operation
         blocking_timeout = 30  # no more than 30 seconds waiting for the lock
         with ctx(integration=self.integration, user=self.integration.user):
@@ -223,6 +495,18 @@ class SyncAdapter(object):
         """
         raise NotImplementedError("Has to be implemented in a subclass")
 
+    def push_tasks(self, tasks):
+        """
+        Add several tasks to the storage. Accepts the list of
+        (task_id, task, extra) tuples, and returns the list of
+        (new_task_id, new_extra) tuples in the same order.
+
+        Calls `push_task` for every task by default. Override it, if the
+        storage can handle batches by itself
+        """
+        return [self.push_task(task_id, task, extra)
+                for task_id, task, extra in tasks]
+
     def delete_task(self, task_id, extra):
         """
         Delete task from the storage
@@ -359,12 +643,24 @@ def normalize_due_date(due_date):
     return due_date
 
 
+def hashes_match(mapping, source_side, target_side, source_hash, target_hash):
+    """
+    Return True if the task with given hashes has been pushed already
+    """
+    return (mapping.side(source_side).hash == source_hash or
+            mapping.side(target_side).hash == target_hash)
+
+
 def get_hash(obj, essential_fields):
     subset = {k: v for k, v in obj._asdict().items() if k in essential_fields}
     str_obj = json.dumps(subset, separators=',:', sort_keys=True, default=json_default)
     return hashlib.sha256(force_bytes(str_obj)).hexdigest()
 
 
+def get_declined_hash(task, target):
+    return get_hash(task, target.ESSENTIAL_FIELDS)[:DECLINED_HASH_LENGTH]
+
+
 def json_default(obj):
     if obj is undefined:
         # we need something to be clearly distinguishable from null,
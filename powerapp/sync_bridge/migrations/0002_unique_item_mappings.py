@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def delete_duplicate_mappings(apps, schema_editor):
+    """
+    Mappings used to be looked up with `order_by('-id').first()`, so for every
+    duplicate only the latest mapping was effectively in use. Keep it, and
+    delete the rest
+    """
+    ItemMapping = apps.get_model('sync_bridge', 'ItemMapping')
+    for side in ['left_id', 'right_id']:
+        duplicates = (ItemMapping.objects
+                      .filter(**{'%s__isnull' % side: False})
+                      .values('integration_id', 'bridge_name', side)
+                      .annotate(max_id=models.Max('id'), cnt=models.Count('id'))
+                      .filter(cnt__gt=1))
+        for dup in duplicates:
+            (ItemMapping.objects
+             .filter(integration_id=dup['integration_id'],
+                     bridge_name=dup['bridge_name'],
+                     **{side: dup[side]})
+             .exclude(id=dup['max_id'])
+             .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sync_bridge', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_mappings, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='itemmapping',
+            unique_together=set([('integration', 'bridge_name', 'left_id'), ('integration', 'bridge_name', 'right_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='itemmapping',
+            index_together=set([]),
+        ),
+    ]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Case, When, Value, Q
 from django.utils.text import Truncator
 from picklefield.fields import PickledObjectField
 
@@ -23,6 +24,81 @@ class BridgeManager(models.Manager):
         return self.get_queryset().get(integration=bridge.integration,
                                        bridge_name=bridge.name, **kwargs)
 
+    def bulk_update(self, objs, fields):
+        """
+        Save given fields of several objects in one statement
+        """
+        if not objs:
+            return
+        updates = {}
+        for field_name in fields:
+            field = self.model._meta.get_field(field_name)
+            whens = [When(id=obj.id, then=Value(getattr(obj, field_name),
+                                                output_field=field))
+                     for obj in objs]
+            updates[field_name] = Case(*whens, output_field=field)
+        self.get_queryset().filter(id__in=[obj.id for obj in objs]).update(**updates)
+
+    def upsert(self, obj, side):
+        """
+        Save the new mapping. If mappings with the same id of either side
+        have been saved by someone else in the meantime, overwrite them.
+
+        PostgreSQL handles conflicts by ids of the `side` in one
+        INSERT ... ON CONFLICT statement. Other conflicts (and all conflicts
+        for other databases, like SQLite in dev environment) are resolved by
+        updating the existing mapping
+        """
+        try:
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    self.insert_on_conflict(obj, side)
+                else:
+                    obj.save(force_insert=True)
+            return obj
+        except IntegrityError:
+            obj.id = None
+
+        lookup = Q()
+        for side_name in ['left', 'right']:
+            side_id = obj.side(side_name).id
+            if side_id is not None:
+                lookup |= Q(**{'%s_id' % side_name: side_id})
+        with transaction.atomic():
+            existing = list(self.get_queryset()
+                            .select_for_update()
+                            .filter(lookup,
+                                    integration_id=obj.integration_id,
+                                    bridge_name=obj.bridge_name)
+                            .order_by('id'))
+            if not existing:
+                # the conflicting mapping has been deleted in the meantime
+                obj.save(force_insert=True)
+                return obj
+            # the mapping can conflict with two mappings, one by each side
+            self.get_queryset().filter(id__in=[m.id for m in existing[1:]]).delete()
+            obj.id = existing[0].id
+            obj.save(force_update=True)
+        return obj
+
+    def insert_on_conflict(self, obj, side):
+        fields = [f for f in self.model._meta.concrete_fields if not f.primary_key]
+        values = [f.get_db_prep_save(f.pre_save(obj, True), connection)
+                  for f in fields]
+        qn = connection.ops.quote_name
+        columns = [qn(f.column) for f in fields]
+        sql = (
+            'INSERT INTO {table} ({columns}) VALUES ({values}) '
+            'ON CONFLICT ({conflict}) DO UPDATE SET {updates} RETURNING id'
+        ).format(table=qn(self.model._meta.db_table),
+                 columns=', '.join(columns),
+                 values=', '.join(['%s'] * len(columns)),
+                 conflict=', '.join(qn(c) for c in ['integration_id', 'bridge_name',
+                                                    '%s_id' % side]),
+                 updates=', '.join('%s = EXCLUDED.%s' % (c, c) for c in columns))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, values)
+            obj.id = cursor.fetchone()[0]
 
 
 class ItemMapping(models.Model):
@@ -46,7 +122,7 @@ class ItemMapping(models.Model):
         return SideProxy(self, side_name)
 
     class Meta:
-        index_together = [
+        unique_together = [
             ['integration', 'bridge_name', 'left_id'],
             ['integration', 'bridge_name', 'right_id'],
         ]
@@ -40,7 +40,8 @@ class TodoistSyncAdapter(SyncAdapter):
         else:
             content = defined(kwargs.pop('content', 'New Task'), 'New Task')
             obj = self.api.items.add(content, self.project_id, **kwargs)
-            return_or_raise(self.api.commit())
+            # we need the real id of the task right away
+            return_or_raise(self.api.commit(defer=False))
             return obj['id'], {}  # return task_id and extra
 
     def complete_task(self, task_id, extra):
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from django.utils.timezone import now
+from powerapp.core import cron
+from powerapp.core.models import Integration
+from powerapp.core.models.integration import get_next_sync, SYNC_PERIOD, \
+    SYNC_JITTER, MAX_SYNC_PERIOD, get_sync_period
+
+
+def test_claim_due_integrations(detached_integration):
+    detached_integration.stateless = False
+    detached_integration.save()
+    with patch.object(cron, 'get_synced_services', return_value=['catcomments']):
+        assert cron.claim_due_integrations() == [detached_integration.id]
+
+        # the next sync is moved forward, and the integration isn't claimed again
+        assert cron.claim_due_integrations() == []
+    integration = Integration.objects.get(id=detached_integration.id)
+    assert integration.api_next_sync > integration.api_last_sync
+
+
+def test_claim_due_integrations_skips_services_without_receivers(detached_integration):
+    detached_integration.stateless = False
+    detached_integration.save()
+    with patch.object(cron, 'get_synced_services', return_value=[]):
+        assert cron.claim_due_integrations() == []
+
+
+def test_claim_due_integrations_skips_stateless(detached_integration):
+    assert cron.claim_due_integrations() == []
+
+
+def test_split():
+    assert cron.split([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert cron.split([], 2) == []
+
+
+def test_run_sync_tasks_isolates_failures(detached_integration, quiet_sync):
+    quiet_sync.side_effect = RuntimeError('Todoist is down')
+    # doesn't raise anything
+    cron.run_sync_tasks([detached_integration.id])
+
+
+def test_next_sync_keeps_integration_slot():
+    threshold = now()
+    next_syncs = [get_next_sync(1, threshold) for _ in range(10)]
+    assert max(next_syncs) - min(next_syncs) <= SYNC_JITTER
+    for next_sync in next_syncs:
+        assert SYNC_PERIOD / 2 <= next_sync - threshold <= SYNC_PERIOD * 3 / 2 + SYNC_JITTER
+
+
+def test_next_sync_spreads_integrations():
+    # split the sync period into 20 buckets, and make sure integrations get
+    # to many of them, whatever the period is
+    threshold = now()
+    bucket = (SYNC_PERIOD / 20).total_seconds()
+    next_syncs = {(get_next_sync(integration_id, threshold) - threshold).total_seconds() // bucket
+                  for integration_id in range(100)}
+    assert len(next_syncs) > 10
+
+
+def test_sync_period_backs_off():
+    assert get_sync_period(0) == SYNC_PERIOD
+    assert get_sync_period(1) == SYNC_PERIOD * 2
+    assert get_sync_period(1000) == MAX_SYNC_PERIOD
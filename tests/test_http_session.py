@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from powerapp.core import http_session
+
+
+def test_session_is_shared():
+    assert http_session.get_session() is http_session.get_session()
+
+
+def test_session_is_recreated_after_fork():
+    session = http_session.get_session()
+    with patch.object(http_session.os, 'getpid', return_value=-1):
+        assert http_session.get_session() is not session
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import uuid
+import pytest
+from powerapp.core import single_flight
+
+
+def test_result_is_shared_with_waiters():
+    key = uuid.uuid4().hex
+    started = threading.Event()
+    results = []
+
+    def slow_call():
+        started.set()
+        time.sleep(0.3)
+        return {'foo': 1}
+
+    flight = threading.Thread(target=lambda: results.append(single_flight.run(key, slow_call)))
+    flight.start()
+    started.wait()
+    assert single_flight.run(key, lambda: {'foo': 2}) == (True, {'foo': 1})
+    flight.join()
+    assert results == [(False, {'foo': 1})]
+
+
+def test_result_is_not_reused_after_flight():
+    key = uuid.uuid4().hex
+    assert single_flight.run(key, lambda: {'foo': 1}) == (False, {'foo': 1})
+    assert single_flight.run(key, lambda: {'foo': 2}) == (False, {'foo': 2})
+
+
+def test_failed_call_is_not_shared():
+    key = uuid.uuid4().hex
+
+    def fail():
+        raise RuntimeError('Todoist is down')
+
+    with pytest.raises(RuntimeError):
+        single_flight.run(key, fail)
+    assert single_flight.run(key, lambda: {'foo': 1}) == (False, {'foo': 1})
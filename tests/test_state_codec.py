@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import pytest
+from django.core.management import call_command
+from django.utils.six import StringIO
+from powerapp.core import state_codec
+from powerapp.core.models import User
+
+
+def test_encode_decode():
+    data = {'state': {'Items': [{'id': 1, 'content': u'фу'}]}, 'seq_no': 10}
+    raw = state_codec.encode(data)
+    assert raw[0] == state_codec.DEFAULT_VERSION
+    assert state_codec.decode(raw) == data
+    assert state_codec.EncodedState(raw).decode() == data
+
+
+def test_decode_unknown_version():
+    with pytest.raises(ValueError):
+        state_codec.decode(b'\xff' + b'foo')
+
+
+def test_convert_empty_legacy_state(detached_user):
+    User.objects.filter(id=detached_user.id).update(api_state_pickled='')
+    call_command('convert_api_states', stdout=StringIO())
+    user = User.objects.get(id=detached_user.id)
+    assert user.api_state is None
+    assert user.api_state_pickled is None
+    assert user.api.token == 'x'
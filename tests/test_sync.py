@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from todoist import models
+from powerapp.core.app_signals import ServiceAppSignals
+from powerapp.core.models import Integration
+from powerapp.core.redis_utils import get_redis
+from powerapp.core.sync import StatefulTodoistAPI, StatelessTodoistAPI, \
+    command_batch, get_fingerprint, sync_integrations
+
+
+def item(item_id, is_deleted=0):
+    return {'id': item_id, 'is_deleted': is_deleted}
+
+
+def test_classify_sync_result():
+    api = StatefulTodoistAPI('token')
+    api.ensure_known_ids()
+
+    events = api.classify_sync_result({'Items': [item(1)]})
+    assert events == [('todoist_task_added', item(1))]
+
+    events = api.classify_sync_result({'Items': [dict(item(1), content='foo')],
+                                       'Notes': [item(1)]})
+    assert events == [('todoist_task_updated', dict(item(1), content='foo')),
+                      ('todoist_note_added', item(1))]
+
+    events = api.classify_sync_result({'Items': [item(1, is_deleted=1)]})
+    assert events == [('todoist_task_deleted', item(1, is_deleted=1))]
+    assert api.known_ids['Items'] == {}
+
+
+def test_known_ids_survive_serialization():
+    api = StatefulTodoistAPI('token')
+    api.ensure_known_ids()
+    api.classify_sync_result({'Projects': [item(1)]})
+    api = StatefulTodoistAPI.deserialize(api.serialize())
+    assert list(api.known_ids['Projects']) == [1]
+
+
+def test_classify_sync_result_skips_unchanged_updates():
+    api = StatefulTodoistAPI('token')
+    api.ensure_known_ids()
+    api.classify_sync_result({'Items': [dict(item(1), content='foo')]})
+
+    events = api.classify_sync_result({'Items': [dict(item(1), content='foo', day_order=2)]})
+    assert events == []
+
+    events = api.classify_sync_result({'Items': [dict(item(1), content='bar')]})
+    assert events == [('todoist_task_updated', dict(item(1), content='bar'))]
+
+
+def test_state_objects_saved_by_delta(detached_integration):
+    api = StatefulTodoistAPI('token')
+    api.integration = detached_integration
+    api.state['Items'] = [models.Item(item(1), api), models.Item(item(2), api)]
+    api.save_state({})
+    assert detached_integration.state_objects.count() == 2
+
+    # item 1 is updated, item 2 is deleted
+    api.state['Items'] = [models.Item(dict(item(1), content='foo'), api)]
+    api.save_state({'Items': [dict(item(1), content='foo'), item(2, is_deleted=1)]})
+    assert [obj.data.decode() for obj in detached_integration.state_objects.all()] == \
+        [dict(item(1), content='foo')]
+
+    # nothing changed, the header isn't rewritten
+    assert not api.save_state({})
+
+    restored = StatefulTodoistAPI.create(detached_integration)
+    # known ids are read from rows without their data, objects are loaded lazily
+    restored.ensure_known_ids()
+    assert restored.known_ids['Items'] == {1: get_fingerprint('Items', dict(item(1), content='foo'))}
+    assert restored.state.loader is not None
+    assert [obj.data for obj in restored.state['Items']] == [dict(item(1), content='foo')]
+
+
+def test_state_objects_saved_under_real_ids(detached_integration):
+    api = StatefulTodoistAPI('token')
+    api.integration = detached_integration
+    api.ensure_known_ids()
+    api.save_state({})
+    new_item = models.Item({'id': 'temp', 'content': 'foo', 'is_deleted': 0}, api)
+    new_item.temp_id = 'temp'
+    api.state['Items'].append(new_item)
+
+    api.process_sync_result({'TempIdMapping': {'temp': 5}}, commands=[{}])
+    assert list(detached_integration.state_objects.values_list('object_key', flat=True)) == ['5']
+
+
+def clear_single_flight_keys():
+    redis = get_redis()
+    keys = redis.keys('single-flight-*')
+    if keys:
+        redis.delete(*keys)
+
+
+def test_sync_integrations_shares_requests(detached_integration, quiet_sync):
+    clear_single_flight_keys()
+    sibling = Integration.objects.create(name='sibling',
+                                         service=detached_integration.service,
+                                         user=detached_integration.user)
+    for integration in [detached_integration, sibling]:
+        integration.api = StatefulTodoistAPI('token')
+        integration.api.integration = integration
+
+    synced = sync_integrations([detached_integration], siblings=[sibling])
+    assert synced == [sibling]
+    assert quiet_sync.call_count == 1
+
+
+def test_resource_types_follow_receivers():
+    signals = ServiceAppSignals()
+    assert signals.get_resource_types() == []
+
+    def receiver(**kwargs):
+        pass
+
+    signals.todoist_task_added.connect(receiver)
+    signals.todoist_note_deleted.connect(receiver)
+    assert signals.get_resource_types() == ['items', 'notes']
+
+
+def test_command_batch(detached_integration, quiet_sync):
+    api1, api2 = StatelessTodoistAPI('token'), StatelessTodoistAPI('token')
+    api1.integration = api2.integration = detached_integration
+    with command_batch():
+        obj = api1.items.add('foo', 1)
+        api1.commit()
+        api2.item_delete(1)
+        api2.commit()
+        assert quiet_sync.call_count == 0
+        quiet_sync.return_value = {'TempIdMapping': {obj.temp_id: 42}}
+
+    assert quiet_sync.call_count == 1
+    assert len(quiet_sync.call_args[0][0]) == 2
+    assert obj['id'] == 42
+
+
+def test_idle_syncs_dont_overwrite_reset(detached_integration):
+    api = StatefulTodoistAPI('token')
+    api.integration = detached_integration
+    api.ensure_known_ids()
+    detached_integration.api_idle_syncs = 3
+    # the webhook handler resets the counter while we're syncing
+    Integration.objects.filter(id=detached_integration.id).update(api_idle_syncs=0)
+
+    api.process_sync_result({})
+    assert Integration.objects.get(id=detached_integration.id).api_idle_syncs == 1
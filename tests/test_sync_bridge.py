@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import pytest
 import uuid
+from mock import patch
 from powerapp.sync_bridge.bridge import SyncBridge, SyncAdapter, task, get_hash, \
     TASK_FIELDS
 from powerapp.sync_bridge.models import ItemMapping
@@ -133,3 +134,118 @@ def test_essential_fields(td, dumb, dumb_bridge):
     dumb_bridge.push_task(td, 1, task(content='foo', indent=2))
     mapping = ItemMapping.objects.bridge_get(dumb_bridge, left_id=1)
     assert mapping.left_hash != mapping.right_hash
+
+
+def test_bridge_skips_unchanged_tasks_without_lock(td, gh, bridge):
+    bridge.push_task(td, 1, task(content='foo'))
+    bridge.lock_and_ctx = None  # taking the lock would fail
+    bridge.push_task(td, 1, task(content='foo'))
+    assert len(gh.storage) == 1
+
+
+def test_bridge_passes_task_batches_through(td, gh, bridge):
+    bridge.push_task(td, 1, task(content='foo'))
+    bridge.push_tasks(td, [(1, task(content='bar')), (2, task(content='baz'))])
+
+    m1 = ItemMapping.objects.bridge_get(bridge, left_id=1)
+    m2 = ItemMapping.objects.bridge_get(bridge, left_id=2)
+    assert gh.storage[m1.right_id].content == 'bar'
+    assert gh.storage[m2.right_id].content == 'baz'
+    assert m2.right_extra == {'foo': 'bar'}
+    assert m2.left_hash == get_hash(task(content='baz'), essential_fields=TASK_FIELDS)
+    assert len(gh.storage) == 2
+
+
+class DecliningSampleAdapter(SampleAdapter):
+    DEFAULT_NAME = 'declining'
+
+    def push_task(self, task_id, task, extra):
+        if task.content == 'skip':
+            return None, None
+        return super(DecliningSampleAdapter, self).push_task(task_id, task, extra)
+
+
+def test_declined_tasks_dont_get_mappings(detached_integration, td):
+    bridge = SyncBridge(detached_integration, td, DecliningSampleAdapter())
+    with patch.object(ItemMapping, 'delete') as delete:
+        bridge.push_task(td, 1, task(content='skip'))
+        bridge.push_tasks(td, [(2, task(content='skip'))])
+    assert not ItemMapping.objects.bridge_filter(bridge).exists()
+    assert delete.call_count == 0
+
+
+def test_upsert_overwrites_existing_mapping(bridge):
+    existing = ItemMapping.objects.bridge_create(bridge, left_id='1', right_id='a')
+    mapping = bridge.build_mapping_by_task_id('left', 1)
+    mapping.right_id = 'b'
+    ItemMapping.objects.upsert(mapping, 'left')
+    assert mapping.id == existing.id
+    assert ItemMapping.objects.bridge_get(bridge, left_id='1').right_id == 'b'
+
+
+def test_declined_tasks_are_skipped_until_changed(detached_integration, td):
+    declining = DecliningSampleAdapter()
+    bridge = SyncBridge(detached_integration, td, declining)
+    bridge.push_task(td, 1, task(content='skip'))
+
+    with patch.object(declining, 'push_task') as push_task:
+        bridge.push_task(td, 1, task(content='skip'))
+        bridge.push_tasks(td, [(1, task(content='skip'))])
+    assert push_task.call_count == 0
+
+    bridge.push_task(td, 1, task(content='foo'))
+    assert ItemMapping.objects.bridge_get(bridge, left_id=1).right_id in declining.storage
+
+
+class EchoingSampleAdapter(SampleAdapter):
+    """
+    The adapter which gets the echo of the task while we're still pushing it
+    """
+    DEFAULT_NAME = 'echoing'
+    echo_blocked = None
+
+    def push_task(self, task_id, task, extra):
+        task_id, extra = super(EchoingSampleAdapter, self).push_task(task_id, task, extra)
+        # the echo of the new task has to wait until its mapping is saved
+        echo_lock = self.bridge.lock_and_ctx()
+        self.echo_blocked = not echo_lock.acquire(blocking=False)
+        if not self.echo_blocked:
+            echo_lock.release()
+        return task_id, extra
+
+
+def test_echo_of_new_task_waits_for_mapping(detached_integration, td):
+    echoing = EchoingSampleAdapter()
+    bridge = SyncBridge(detached_integration, td, echoing)
+    bridge.push_task(td, 1, task(content='foo'))
+    assert echoing.echo_blocked
+
+    # once the mapping is saved, the echo is recognized
+    gc_id = ItemMapping.objects.bridge_get(bridge, left_id=1).right_id
+    bridge.push_task(echoing, gc_id, task(content='foo'))
+    assert len(td.storage) == 0
+    assert ItemMapping.objects.bridge_filter(bridge).count() == 1
+
+
+def test_upsert_resolves_conflicts_by_both_sides(bridge):
+    ItemMapping.objects.bridge_create(bridge, left_id='1', right_id='a')
+    ItemMapping.objects.bridge_create(bridge, left_id='2', right_id='b')
+    mapping = bridge.build_mapping_by_task_id('left', 1)
+    mapping.right_id = 'b'
+    ItemMapping.objects.upsert(mapping, 'left')
+    assert list(ItemMapping.objects.bridge_filter(bridge).values_list('left_id', 'right_id')) == \
+        [('1', 'b')]
+
+
+def test_lock_mappings_keeps_concurrently_saved_mappings(bridge):
+    lock_and_ctx = bridge.lock_and_ctx
+
+    def save_while_waiting(mapping_id=None):
+        if mapping_id is None and not ItemMapping.objects.bridge_filter(bridge).exists():
+            # another worker saves the mapping while we're waiting for the lock
+            ItemMapping.objects.bridge_create(bridge, left_id='1', right_id='a')
+        return lock_and_ctx(mapping_id)
+
+    bridge.lock_and_ctx = save_while_waiting
+    with bridge.lock_mappings('left', ['1'], create=True) as mappings:
+        assert mappings['1'].right_id == 'a'
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import datetime
+import pytest
+from django.utils.timezone import now
+from powerapp.core import sync_scheduler
+from powerapp.core.redis_utils import get_redis
+
+
+@pytest.yield_fixture
+def redis_scheduler(settings):
+    settings.SYNC_SCHEDULER = 'redis'
+    get_redis().delete(sync_scheduler.SCHEDULE_KEY)
+    yield
+    get_redis().delete(sync_scheduler.SCHEDULE_KEY)
+
+
+def test_pop_due(redis_scheduler):
+    ts = now()
+    sync_scheduler.schedule([(1, ts - datetime.timedelta(seconds=1)),
+                             (2, ts + datetime.timedelta(seconds=1))])
+    assert sync_scheduler.pop_due(ts) == [1]
+    assert sync_scheduler.pop_due(ts) == []
+
+
+def test_schedule_earlier(redis_scheduler):
+    ts = now()
+    sync_scheduler.schedule([(1, ts + datetime.timedelta(minutes=30)),
+                             (2, ts - datetime.timedelta(minutes=1))])
+    sync_scheduler.schedule_earlier([1, 2], ts)
+    assert sync_scheduler.next_due() == sync_scheduler.to_timestamp(ts - datetime.timedelta(minutes=1))
+    assert sorted(sync_scheduler.pop_due(ts)) == [1, 2]
+
+
+def test_disabled_scheduler_does_nothing(settings):
+    settings.SYNC_SCHEDULER = 'database'
+    get_redis().delete(sync_scheduler.SCHEDULE_KEY)
+    sync_scheduler.schedule([(1, now())])
+    assert sync_scheduler.next_due() is None
+
+
+def test_save_keeps_earlier_due_time(redis_scheduler, detached_integration):
+    detached_integration.stateless = False
+    detached_integration.api_last_sync = now()
+    detached_integration.api_next_sync = now() + datetime.timedelta(hours=1)
+    detached_integration.save()
+    ts = now() - datetime.timedelta(minutes=1)
+    sync_scheduler.schedule_earlier([detached_integration.id], ts)
+
+    detached_integration.update_settings(foo='bar')
+    detached_integration.save(update_fields=['api_next_sync'])
+    assert sync_scheduler.next_due() == sync_scheduler.to_timestamp(ts)
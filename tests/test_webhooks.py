@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import hmac
+import json
+import pytest
+import uuid
+from mock import patch
+from django.conf import settings
+from django.utils.encoding import force_bytes
+from powerapp.core import tasks, webhook_queue, webhook_routes
+from powerapp.core.views import webhooks
+from powerapp.core.webhook_queue import HashRing
+
+
+def signed_request(rf, data, delivery_id='1'):
+    raw_data = force_bytes(json.dumps(data))
+    signature = hmac.new(force_bytes(settings.TODOIST_CLIENT_SECRET),
+                         raw_data, hashlib.sha256).digest()
+    return rf.post('/webhooks/accept/', raw_data,
+                   content_type='application/json',
+                   HTTP_X_TODOIST_HMAC_SHA256=base64.b64encode(signature),
+                   HTTP_X_TODOIST_DELIVERY_ID=delivery_id)
+
+
+@pytest.fixture
+def payload():
+    return [{'event_name': 'item:added',
+             'user_id': 1,
+             'event_data': {'id': 1, 'content': 'foo'}}]
+
+
+def test_sync_webhook_is_handled_immediately(rf, settings, payload):
+    settings.WEBHOOKS_ASYNC = False
+    with patch.object(webhooks, 'handle_webhook_events') as handle, \
+            patch.object(webhooks.webhook_queue, 'push') as push:
+        webhooks.accept(signed_request(rf, payload))
+    assert handle.call_count == 1
+    assert push.call_count == 0
+
+
+def test_async_webhook_is_queued(rf, settings, payload):
+    settings.WEBHOOKS_ASYNC = True
+    with patch.object(webhooks, 'handle_webhook_events') as handle, \
+            patch.object(webhooks.webhook_queue, 'push') as push, \
+            patch.object(webhooks.tasks.process_webhook_queue, 'apply_async') as apply_async:
+        push.return_value = [3]
+        webhooks.accept(signed_request(rf, payload))
+    assert handle.call_count == 0
+    assert push.call_args[0][0] == [dict(ev, delivery_id='1') for ev in payload]
+    apply_async.assert_called_once_with((3, ), countdown=settings.WEBHOOKS_COALESCE_WINDOW)
+
+
+def test_invalid_signature_is_ignored(rf, settings, payload):
+    settings.WEBHOOKS_ASYNC = True
+    request = signed_request(rf, payload)
+    request.META['HTTP_X_TODOIST_HMAC_SHA256'] = 'invalid'
+    with patch.object(webhooks.webhook_queue, 'push') as push:
+        webhooks.accept(request)
+    assert push.call_count == 0
+
+
+def test_hash_ring_is_stable():
+    ring = HashRing(16)
+    assert ring.get_partition(1) == HashRing(16).get_partition(1)
+    assert {ring.get_partition(uid) for uid in range(1000)} == set(range(16))
+
+
+def test_hash_ring_moves_few_users_on_resize():
+    old_ring, new_ring = HashRing(16), HashRing(17)
+    moved = [uid for uid in range(1000)
+             if old_ring.get_partition(uid) != new_ring.get_partition(uid)]
+    assert len(moved) < 200
+
+
+def test_event_digest_ignores_redelivery(payload):
+    redelivered = json.loads(json.dumps(payload))
+    assert webhooks.event_digest(payload[0]) == webhooks.event_digest(redelivered[0])
+
+
+def test_event_digest_tells_deliveries_apart(payload):
+    ev1 = dict(payload[0], delivery_id='1')
+    ev2 = dict(payload[0], delivery_id='2')
+    assert webhooks.event_digest(ev1) != webhooks.event_digest(ev2)
+
+
+def test_failed_events_are_not_marked_seen(settings, payload):
+    settings.WEBHOOKS_DEDUP_TTL = 60
+    ev = dict(payload[0], delivery_id=uuid.uuid4().hex)
+    with patch.object(webhooks.webhook_routes, 'get_routes'), \
+            patch.object(webhooks, 'handle_stateful_integrations'), \
+            patch.object(webhooks, 'handle_stateless_integrations', side_effect=ValueError):
+        with pytest.raises(ValueError):
+            webhooks.handle_webhook_events([ev])
+    assert webhooks.drop_duplicate_events([ev])[0] == [ev]
+
+
+def test_event_digest_tells_updates_apart():
+    ev1 = {'event_name': 'item:updated', 'user_id': 1,
+           'event_data': {'id': 1, 'content': 'foo'}}
+    ev2 = {'event_name': 'item:updated', 'user_id': 1,
+           'event_data': {'id': 1, 'content': 'bar'}}
+    assert webhooks.event_digest(ev1) != webhooks.event_digest(ev2)
+
+
+def ev(event_name, obj_id, user_id=1, **kwargs):
+    return {'event_name': event_name, 'user_id': user_id,
+            'event_data': dict(kwargs, id=obj_id)}
+
+
+def test_coalesce_keeps_latest_update():
+    data = [ev('item:updated', 1, content='foo'),
+            ev('item:updated', 2, content='bar'),
+            ev('item:updated', 1, content='baz')]
+    assert webhooks.coalesce_events(data) == [data[1], data[2]]
+
+
+def test_coalesce_keeps_added_semantics():
+    data = [ev('item:added', 1, content='foo'),
+            ev('item:updated', 1, content='bar')]
+    assert webhooks.coalesce_events(data) == [ev('item:added', 1, content='bar')]
+
+
+def test_coalesce_keeps_deleted_semantics():
+    data = [ev('item:added', 1, content='foo'),
+            ev('item:deleted', 1, content='foo')]
+    assert webhooks.coalesce_events(data) == [data[1]]
+
+
+def test_coalesce_tells_objects_apart():
+    data = [ev('item:updated', 1),
+            ev('project:updated', 1),
+            ev('item:updated', 1, user_id=2)]
+    assert webhooks.coalesce_events(data) == data
+
+
+def test_build_routes(detached_integration):
+    routes = webhook_routes.build_routes([1, 2])
+    assert routes[1] == {'stateless': [[detached_integration.id, 'catcomments']],
+                         'stateful': []}
+    assert routes[2] == {'stateless': [], 'stateful': []}
+
+
+def test_busy_partition_is_not_rescheduled():
+    with patch.object(tasks.webhook_queue, 'drain', return_value=0), \
+            patch.object(tasks.webhook_queue, 'pending', return_value=1), \
+            patch.object(tasks.process_webhook_queue, 'apply_async') as apply_async:
+        tasks.process_webhook_queue(3)
+    assert apply_async.call_count == 0
+
+
+def test_coalesce_keeps_update_before_completion():
+    data = [ev('item:updated', 1, content='foo'),
+            ev('item:completed', 1, content='foo')]
+    assert webhooks.coalesce_events(data) == data
+
+
+def test_coalesce_doesnt_modify_events():
+    data = [ev('item:added', 1, content='foo'),
+            ev('item:uncompleted', 1, content='foo')]
+    webhooks.coalesce_events(data)
+    assert data[1]['event_data'] == {'id': 1, 'content': 'foo'}
+
+
+def test_failed_batch_is_handled_chunk_by_chunk():
+    handled = []
+
+    def handler(events):
+        if len(events) > 1:
+            raise ValueError()
+        handled.extend(events)
+
+    chunks = [[ev('item:updated', 1)], [ev('item:updated', 2)]]
+    webhook_queue.handle_chunks(0, handler, chunks)
+    assert handled == [chunks[0][0], chunks[1][0]]